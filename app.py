@@ -1,43 +1,53 @@
 import os
 
-from flask import Flask
-from elasticsearch import Elasticsearch, exceptions
+from flask import Flask, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from elasticsearch import exceptions
 
 import config
 from config import Config
 from data_models.es_mappings import INDEX_MAPPING, INDEX_NAME
 
-from extensions import redis_client
-
-es = Elasticsearch(
-    [{'host': config.Config.ES_HOST, 'port': 9200, 'scheme': 'http'}],
-    basic_auth=(config.Config.ES_USER, config.Config.ES_PASSWORD)
-)
+from extensions import redis_client, plan_cache, operation_waiter, es, init_clients
 
 
 def create_index_if_not_exists():
+    """One-time setup step, run with `flask --app app init-index` before starting the API."""
     try:
         if not es.indices.exists(index=INDEX_NAME):
-            es.indices.create(index=INDEX_NAME, body=INDEX_MAPPING)
+            # Versioned index behind an alias so `reindex.py` can swap it without downtime
+            es.indices.create(index=f"{INDEX_NAME}_v1", body={**INDEX_MAPPING, "aliases": {INDEX_NAME: {}}})
             print(f"Index '{INDEX_NAME}' created with mappings.")
         else:
             print(f"Index '{INDEX_NAME}' already exists.")
     except exceptions.ConnectionError as e:
         print(f"Error connecting to Elasticsearch: {e}")
-    except exceptions.ElasticsearchException as e:
+    except exceptions.ApiError as e:
         print(f"Error creating index: {e}")
 
 
 def create_app():
     app = Flask(__name__)
-    app.config_class(Config)
+    app.config.from_object(Config)
 
+    # Only configures clients, each process connects on first use (after any fork)
     redis_client.init_app(app)
-    create_index_if_not_exists()
+    init_clients(app)
+    plan_cache.start(redis_client)
+    operation_waiter.start(redis_client)
 
     from medical_plan_bp import api_bp
     app.register_blueprint(api_bp)
 
+    # Outside the blueprint so scrapers need no Google token
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.cli.command('init-index')
+    def init_index():
+        create_index_if_not_exists()
+
     return app
 
 
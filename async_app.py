@@ -0,0 +1,263 @@
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import aio_pika
+from aio_pika.exceptions import ChannelClosed, ChannelInvalidStateError, DeliveryError
+from pydantic import ValidationError
+from quart import Quart, Blueprint, Response, request, jsonify
+
+from config import Config
+from data_models.medical_plan import PlanSchema, PatchPlanSchema
+from rabbitmq import queue_for, queue_message, shard_queue_name
+from services import async_redis_service
+from services.google_auth import GoogleAuth
+from services.operations import AsyncOperationWaiter, requested_wait
+
+api_bp = Blueprint('async_api', __name__)
+
+google_auth = GoogleAuth(Config.GOOGLE_CLIENT_ID,
+                         token_cache_size=Config.AUTH_TOKEN_CACHE_SIZE,
+                         token_cache_ttl=Config.AUTH_TOKEN_CACHE_TTL)
+
+
+class AsyncPublisher:
+    """Publishes over one robust (auto-reconnecting) connection with publisher confirms."""
+
+    def __init__(self, queues):
+        self._queues = queues
+        self._connection = None
+        self._channel = None
+
+    async def connect(self):
+        self._connection = await aio_pika.connect_robust(host=Config.RABBITMQ_HOST, port=Config.RABBITMQ_PORT,
+                                                         login=Config.RABBITMQ_USER,
+                                                         password=Config.RABBITMQ_PASSWORD)
+        self._channel = await self._connection.channel(publisher_confirms=True)
+        for queue_name in self._queues:
+            await self._channel.declare_queue(queue_name, durable=True)
+
+    async def close(self):
+        if self._connection:
+            await self._connection.close()
+
+    async def publish(self, routing_key, body, timeout=5):
+        """
+        Publish `body` to `routing_key` and return once the broker confirmed it.
+
+        Raises ConnectionError while the connection is being restored or if the broker
+        rejected the message and TimeoutError if no confirm arrived within `timeout` seconds.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        message = aio_pika.Message(body=body, headers={'published_at': time.time()},
+                                   delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+        try:
+            await self._channel.default_exchange.publish(message, routing_key=routing_key, timeout=timeout)
+        except (ChannelInvalidStateError, ChannelClosed) as e:
+            raise ConnectionError(f"RabbitMQ channel is not open: {e}") from e
+        except DeliveryError as e:
+            raise ConnectionError("Message was rejected by RabbitMQ") from e
+
+
+publisher = AsyncPublisher(queues=[shard_queue_name(shard) for shard in range(Config.QUEUE_SHARDS)])
+operation_waiter = AsyncOperationWaiter(channel=Config.OPERATION_CHANNEL)
+
+
+@api_bp.route('/health_check', methods=['GET'])
+async def health_check():
+    return "Hello"
+
+
+@api_bp.before_request
+async def before_request_func():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return jsonify({"message": "Token is missing!"}), 401
+
+    token = auth_header.split(" ")[1]
+
+    # Cache hits are answered on the event loop, only a cache miss verifies in a thread
+    decoded_token = google_auth.cached_token(token) or await asyncio.to_thread(google_auth.verify_token, token)
+    if not decoded_token:
+        return jsonify({"message": "Token is invalid!"}), 401
+
+
+def _wait_seconds():
+    return requested_wait(request.headers.get('Prefer'), request.args.get('wait'), Config.OPERATION_MAX_WAIT)
+
+
+async def _queued(operation_id, action, message, status, done_status=200):
+    """`_queued` of medical_plan_bp, waiting on the event loop."""
+    wait = _wait_seconds()
+    headers = {'Location': f"/v1/operations/{operation_id}"}
+    if wait:
+        headers['Preference-Applied'] = f"wait={wait}"
+        result = await operation_waiter.wait(operation_id, wait)
+        if result is not None:
+            if result.get('etag'):
+                headers['ETag'] = result['etag']
+            applied = result['status'] == 'done' and result.get('action') == action
+            return jsonify(result), done_status if applied else 409, headers
+    return jsonify({"message": message, "operation_id": operation_id}), status, headers
+
+
+@api_bp.route('/v1/plan', methods=['POST'])
+async def create_plan():
+    try:
+        plan_schema = PlanSchema.model_validate_json(await request.get_data())
+        operation_id = uuid4().hex
+        await publisher.publish(queue_for(plan_schema.objectId),
+                                queue_message("create", plan_schema.model_dump_json().encode('utf-8'),
+                                              operation_id=operation_id))
+
+        return await _queued(operation_id, "create", "Document queued for processing", 202, done_status=201)
+
+    except ValidationError as e:
+        return Response(e.json(), status=400, mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/plan/<object_id>', methods=['GET'])
+async def get_plan(object_id):
+    try:
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and if_none_match == await async_redis_service.get_etag(object_id):
+            return '', 304
+
+        if Config.VALIDATE_PLAN_READS:
+            plan, etag = await async_redis_service.get_plan(object_id)
+            if plan:
+                return jsonify(plan.dict()), 200, {'ETag': etag}
+            return jsonify({'error': 'Plan not found'}), 404
+
+        plan_data, etag = await async_redis_service.get_raw_plan(object_id)
+        if plan_data:
+            return Response(plan_data, status=200, mimetype='application/json', headers={'ETag': etag})
+        else:
+            return jsonify({'error': 'Plan not found'}), 404
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/plan/<object_id>', methods=['DELETE'])
+async def delete_plan(object_id):
+    try:
+        operation_id = uuid4().hex
+        req = {"action": "delete", "doc_id": object_id, "operation_id": operation_id}
+        await publisher.publish(queue_for(object_id), json.dumps(req))
+
+        return await _queued(operation_id, "delete", "request queued for processing", 200)
+
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+async def _stream_ndjson(plans):
+    async for plan_data in plans:
+        yield plan_data + b"\n"
+
+
+async def _stream_json_array(plans):
+    separator = b"["
+    async for plan_data in plans:
+        yield separator + plan_data
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+@api_bp.route('/v1/plans', methods=['GET'])
+async def get_all_plans():
+    try:
+        if request.args.get('stream') == 'true':
+            plans = async_redis_service.iter_raw_plans(Config.PLANS_PAGE_SIZE)
+            if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+                return Response(_stream_ndjson(plans), mimetype='application/x-ndjson')
+            return Response(_stream_json_array(plans), mimetype='application/json')
+
+        cursor = request.args.get('cursor', 0, type=int)
+        limit = request.args.get('limit', Config.PLANS_PAGE_SIZE, type=int)
+        if cursor < 0 or not 0 < limit <= Config.PLANS_MAX_PAGE_SIZE:
+            return jsonify({'error': f'cursor must be >= 0 and limit between 1 and {Config.PLANS_MAX_PAGE_SIZE}'}), 400
+
+        plans, next_cursor = await async_redis_service.get_all_plans(cursor, limit)
+        return jsonify({
+            "plans": [plan.dict() for plan in plans],
+            "next_cursor": next_cursor or None
+        }), 200
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/patch/<string:key>', methods=['PATCH'])
+async def patch_item(key):
+    try:
+        current_etag = await async_redis_service.get_etag(key)
+        if not current_etag:
+            return jsonify({"message": "Item not found"}), 404
+
+        if current_etag != request.headers.get('If-Match'):
+            return jsonify({"message": "ETag does not match"}), 412
+
+        new_plan = PatchPlanSchema.model_validate_json(await request.get_data())
+
+        # The consumer re-checks the ETag when it applies the patch, the operation id
+        # lets it recognise a redelivered patch it applied before
+        operation_id = uuid4().hex
+        await publisher.publish(queue_for(new_plan.objectId),
+                                queue_message("patch", new_plan.model_dump_json().encode('utf-8'),
+                                              etag=current_etag, operation_id=operation_id))
+
+        return await _queued(operation_id, "patch", "request queued for processing", 200)
+
+    except ValidationError as e:
+        return Response(e.json(), status=400, mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/operations/<operation_id>', methods=['GET'])
+async def get_operation(operation_id):
+    try:
+        # Long-poll with ?wait=N or `Prefer: wait=N`, answered as soon as the consumer reports
+        wait = _wait_seconds()
+        if wait:
+            result = await operation_waiter.wait(operation_id, wait)
+        else:
+            result = await operation_waiter.result(operation_id)
+        if result is None:
+            return jsonify({"operation_id": operation_id, "status": "pending"}), 202
+        return jsonify(result), 200
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+def create_app():
+    app = Quart(__name__)
+
+    @app.before_serving
+    async def connect():
+        await publisher.connect()
+        operation_waiter.start(async_redis_service.redis_client)
+
+    @app.after_serving
+    async def disconnect():
+        await publisher.close()
+        await operation_waiter.close()
+        await async_redis_service.redis_client.aclose()
+
+    app.register_blueprint(api_bp)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,124 @@
+"""In-process stand-ins for the Redis, Elasticsearch and RabbitMQ the API and consumer talk to."""
+import json
+import socket
+import threading
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fakeredis import TcpFakeServer
+
+
+class RedisServer(TcpFakeServer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Connection handlers must not keep the process alive once the benchmark is done
+        self.daemon_threads = True
+
+    def get_request(self):
+        # Like Redis itself, so replies to pipelines are not held back by Nagle's algorithm
+        connection, address = super().get_request()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+
+def start_redis(port=0):
+    """fakeredis behind a real socket, so redis-py clients connect unchanged. Returns its port."""
+    server = RedisServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+class ElasticsearchHandler(BaseHTTPRequestHandler):
+    """Answers the handful of APIs the app uses: index checks, _bulk and _search."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body=None, status=200):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        # The 8.x client refuses to talk to servers that do not identify as Elasticsearch
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _bulk(self):
+        items = []
+        lines = iter(line for line in self._body().splitlines() if line.strip())
+        for line in lines:
+            (action, meta), = json.loads(line).items()
+            if action != 'delete':
+                next(lines)
+            items.append({action: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 200}})
+        self.server.count(item for entry in items for item in entry)
+        self._reply({'took': 0, 'errors': False, 'items': items})
+
+    def _search(self):
+        self._body()
+        self._reply({'took': 0, 'timed_out': False,
+                     'hits': {'total': {'value': 0, 'relation': 'eq'}, 'hits': []}})
+
+    def do_HEAD(self):
+        # Every index exists
+        self._reply()
+
+    def do_GET(self):
+        if self.path.split('?')[0].endswith('/_search'):
+            return self._search()
+        self._reply({'version': {'number': '8.13.0'}, 'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/_bulk'):
+            return self._bulk()
+        if path.endswith('/_search'):
+            return self._search()
+        self._body()
+        self._reply({'acknowledged': True})
+
+    do_PUT = do_POST
+
+
+class ElasticsearchStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), ElasticsearchHandler)
+        self.operations = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, actions):
+        with self._lock:
+            self.operations.update(actions)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+
+class InMemoryPublisher:
+    """`rabbitmq.Publisher` interface, keeping the messages of every queue in memory."""
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+
+    def publish(self, routing_key, body, timeout=5):
+        self.queues[routing_key].append(body)
+
+    def publish_many(self, messages, timeout=5):
+        for routing_key, body in messages:
+            self.publish(routing_key, body)
+
+    def drain(self):
+        bodies = []
+        for queue in self.queues.values():
+            while queue:
+                bodies.append(queue.popleft())
+        return bodies
@@ -0,0 +1,54 @@
+"""Synthetic plans shaped like data/use case.json."""
+import copy
+import json
+import os
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'use case.json')
+
+with open(TEMPLATE_PATH) as f:
+    TEMPLATE = json.load(f)
+
+
+def _object_id(rng):
+    # From `rng` so the same seed produces the same plans
+    return f"{rng.getrandbits(128):032x}"
+
+
+def make_service(rng, index):
+    service = copy.deepcopy(TEMPLATE['linkedPlanServices'][index % len(TEMPLATE['linkedPlanServices'])])
+    service['objectId'] = _object_id(rng)
+    service['linkedService']['objectId'] = _object_id(rng)
+    service['linkedService']['name'] = f"{service['linkedService']['name']} {index}"
+    service['planserviceCostShares']['objectId'] = _object_id(rng)
+    service['planserviceCostShares']['copay'] = rng.randint(0, 500)
+    service['planserviceCostShares']['deductible'] = rng.randint(0, 5000)
+    return service
+
+
+def make_plan(rng, services=2):
+    """A plan with fresh objectIds and `services` linked plan services."""
+    plan = copy.deepcopy(TEMPLATE)
+    plan['objectId'] = _object_id(rng)
+    plan['planType'] = rng.choice(['inNetwork', 'outOfNetwork'])
+    plan['planCostShares']['objectId'] = _object_id(rng)
+    plan['planCostShares']['copay'] = rng.randint(0, 500)
+    plan['planCostShares']['deductible'] = rng.randint(0, 5000)
+    plan['linkedPlanServices'] = [make_service(rng, index) for index in range(services)]
+    return plan
+
+
+def make_patch(rng, plan):
+    """A patch changing the plan's cost shares and the copay of one of its services."""
+    service = rng.choice(plan['linkedPlanServices'])
+    return {
+        'objectId': plan['objectId'],
+        'planCostShares': {'objectId': plan['planCostShares']['objectId'], 'copay': rng.randint(0, 500)},
+        'linkedPlanServices': [{'objectId': service['objectId'],
+                                'planserviceCostShares': {'objectId': service['planserviceCostShares']['objectId'],
+                                                          'copay': rng.randint(0, 500)}}],
+    }
+
+
+def make_service_patch(rng, service):
+    return {'planserviceCostShares': {'objectId': service['planserviceCostShares']['objectId'],
+                                      'deductible': rng.randint(0, 5000)}}
@@ -0,0 +1,183 @@
+"""
+Benchmarks of the API and the consumer commands against in-process stand-ins
+for Redis, Elasticsearch and RabbitMQ, nothing else needs to be running:
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python -m benchmarks.run --plans 1000 --services 4 --save
+
+Results are compared with the saved baseline of the same name and slower
+numbers than `--tolerance` allows are reported as regressions.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from hashlib import sha256
+
+from benchmarks import fakes, plans
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+TOKEN = 'benchmark-token'
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 3)
+
+    return {'count': len(latencies), 'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(50), 'p95_ms': percentile(95), 'p99_ms': percentile(99)}
+
+
+def measure(requests, expected_status):
+    """Run `requests` (callables returning a response) one after another and time each one."""
+    latencies = []
+    started = time.perf_counter()
+    for send in requests:
+        request_started = time.perf_counter()
+        response = send()
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code != expected_status:
+            raise RuntimeError(f"Expected {expected_status}, got {response.status_code}: {response.get_data()[:200]}")
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def consume(consumer, bodies, batch_size):
+    """Feed queued messages through the consumer in batches, like `consume_batches` does."""
+    started = time.perf_counter()
+    for start in range(0, len(bodies), batch_size):
+        consumer.batch_callback(bodies[start:start + batch_size])
+    elapsed = time.perf_counter() - started
+    return {'messages': len(bodies), 'throughput': round(len(bodies) / elapsed, 1)}
+
+
+def run(plan_count, services, seed):
+    # Point the services at the stand-ins before anything reads the config
+    es_stub = fakes.ElasticsearchStub()
+    os.environ['REDIS_HOST'] = os.environ['ES_HOST'] = '127.0.0.1'
+    os.environ['REDIS_PORT'] = str(fakes.start_redis())
+    os.environ['ES_PORT'] = str(es_stub.start())
+    # Required settings of services that are replaced by the stand-ins
+    os.environ.setdefault('ES_PASSWORD', 'benchmark')
+
+    from config import Config
+    from app import app
+    from extensions import clients, google_auth, plan_cache
+    import consumer
+
+    # fakeredis' server drops a connection after any error reply, including the NOSCRIPT
+    # that EVALSHA answers before the merge script is loaded
+    consumer.redis_client.script_load(consumer.MERGE_PLAN_SCRIPT)
+
+    publisher = fakes.InMemoryPublisher()
+    clients.register('publisher', lambda: publisher)
+    # Accept the benchmark token without asking Google
+    google_auth._verified_tokens[sha256(TOKEN.encode('utf-8')).digest()] = {'sub': 'benchmark', 'exp': time.time() + 86400}
+
+    client = app.test_client()
+    auth = {'Authorization': f'Bearer {TOKEN}'}
+    rng = random.Random(seed)
+    documents = [plans.make_plan(rng, services) for _ in range(plan_count)]
+    api, consumed = {}, {}
+
+    def etag(document):
+        return consumer.redis_client.get(f"etag:{document['objectId']}").decode('utf-8')
+
+    def consume_queued():
+        results = consume(consumer, publisher.drain(), Config.CONSUMER_BATCH_SIZE)
+        # Invalidations reach the API's cache asynchronously, start the next phase from Redis
+        plan_cache.clear()
+        return results
+
+    api['POST'] = measure([lambda d=d: client.post('/v1/plan', json=d, headers=auth) for d in documents], 202)
+    consumed['create'] = consume_queued()
+
+    api['GET'] = measure([lambda d=d: client.get(f"/v1/plan/{d['objectId']}", headers=auth) for d in documents], 200)
+    # ETags and patches are prepared up front so only the requests are timed
+    api['GET If-None-Match'] = measure([lambda d=d, e=etag(d): client.get(f"/v1/plan/{d['objectId']}",
+                                                                          headers={**auth, 'If-None-Match': e})
+                                        for d in documents], 304)
+
+    api['PATCH'] = measure([lambda d=d, e=etag(d), p=plans.make_patch(rng, d):
+                            client.patch(f"/v1/patch/{d['objectId']}", json=p, headers={**auth, 'If-Match': e})
+                            for d in documents], 200)
+    consumed['patch'] = consume_queued()
+
+    for d in documents:
+        service = rng.choice(d['linkedPlanServices'])
+        client.patch(f"/v1/plan/{d['objectId']}/linkedPlanServices/{service['objectId']}",
+                     json=plans.make_service_patch(rng, service), headers={**auth, 'If-Match': etag(d)})
+    consumed['patch_service'] = consume_queued()
+
+    for d in documents:
+        client.delete(f"/v1/plan/{d['objectId']}", headers=auth)
+    consumed['delete'] = consume_queued()
+
+    return {
+        'config': {'plans': plan_count, 'services': services, 'plan_codec': Config.PLAN_CODEC,
+                   'plan_storage': Config.PLAN_STORAGE, 'consumer_batch_size': Config.CONSUMER_BATCH_SIZE},
+        'api': api,
+        'consumer': consumed,
+        'elasticsearch_operations': dict(es_stub.operations),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing every metric that is worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for section in ('api', 'consumer'):
+        for name, metrics in results[section].items():
+            for metric, value in metrics.items():
+                old = baseline.get(section, {}).get(name, {}).get(metric)
+                if not old or metric in ('count', 'messages'):
+                    continue
+                # Throughput should not drop, latencies should not grow
+                change = (old - value) / old if metric == 'throughput' else (value - old) / old
+                if change > tolerance:
+                    regressions.append(f"{section} {name} {metric}: {old} -> {value} ({change:+.0%} worse)")
+    return regressions
+
+
+def report(results):
+    print(f"{'API':<20}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, metrics in results['api'].items():
+        print(f"{name:<20}{metrics['throughput']:>10}{metrics['p50_ms']:>10}{metrics['p95_ms']:>10}{metrics['p99_ms']:>10}")
+    print(f"\n{'Consumer':<20}{'msg/s':>10}")
+    for action, metrics in results['consumer'].items():
+        print(f"{action:<20}{metrics['throughput']:>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the API and consumer against local stand-ins.")
+    parser.add_argument('--plans', type=int, default=500)
+    parser.add_argument('--services', type=int, default=2, help="linkedPlanServices per plan")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default='default', help="name of the baseline file in benchmarks/baselines")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before failing, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    results = run(args.plans, args.services, args.seed)
+    report(results)
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{args.baseline}.json")
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline '{baseline_path}'")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline['config'] != results['config']:
+            print(f"\nBaseline '{baseline_path}' was recorded with {baseline['config']}, not comparing")
+            sys.exit(0)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"\nNo regressions against '{baseline_path}'")
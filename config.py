@@ -2,17 +2,43 @@ import os
 
 
 class Config:
-    REDIS_HOST = 'localhost'
-    REDIS_PORT = 6379
+    REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+    REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
     REDIS_DB = 0
     REDIS_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}'
     GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
     GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-    ES_HOST = 'localhost'
-    ES_PORT = 9200
+    ES_HOST = os.getenv('ES_HOST', 'localhost')
+    ES_PORT = int(os.getenv('ES_PORT', 9200))
     ES_USER = "elastic"
     ES_PASSWORD = os.getenv("ES_PASSWORD")
     RABBITMQ_USER = os.getenv('RABBITMQ_USER')
     RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD')
     RABBITMQ_HOST = os.getenv('RABBITMQ_HOST')
-    RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT'))
+    RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
+    CONSUMER_PREFETCH_COUNT = int(os.getenv('CONSUMER_PREFETCH_COUNT', 500))
+    CONSUMER_BATCH_SIZE = int(os.getenv('CONSUMER_BATCH_SIZE', 200))
+    CONSUMER_BATCH_WAIT = float(os.getenv('CONSUMER_BATCH_WAIT', 0.05))
+    # Skip writes that a later create or delete of the plan within one batch replaces, the batch wait is the window
+    CONSUMER_COALESCE = os.getenv('CONSUMER_COALESCE', 'true') == 'true'
+    # consumer.py <shard> serves its metrics on CONSUMER_METRICS_PORT + shard
+    CONSUMER_METRICS_PORT = int(os.getenv('CONSUMER_METRICS_PORT', 9100))
+    QUEUE_DEPTH_INTERVAL = 5
+    QUEUE_NAME = 'medical_plan'
+    QUEUE_SHARDS = int(os.getenv('QUEUE_SHARDS', 1))
+    PLANS_PAGE_SIZE = 100
+    PLANS_MAX_PAGE_SIZE = 1000
+    # Plans of POST /v1/plans:batch published per round of broker confirms
+    INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10000))
+    AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 300))
+    VALIDATE_PLAN_READS = os.getenv('VALIDATE_PLAN_READS') == 'true'
+    PLAN_CACHE_MAX_BYTES = int(os.getenv('PLAN_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    PLAN_INVALIDATION_CHANNEL = 'plan_invalidations'
+    OPERATION_CHANNEL = 'operation_completions'
+    OPERATION_RESULT_TTL = 3600
+    # Longest a request may block with `Prefer: wait=N` or GET /v1/operations/<id>?wait=N
+    OPERATION_MAX_WAIT = int(os.getenv('OPERATION_MAX_WAIT', 30))
+    PLAN_CODEC = os.getenv('PLAN_CODEC', 'json')
+    # 'document' stores a plan as one value, 'normalized' as one hash per object
+    PLAN_STORAGE = os.getenv('PLAN_STORAGE', 'document')
@@ -1,220 +1,357 @@
 from abc import ABC, abstractmethod
 import json
+import sys
+import elasticsearch
 from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import BulkIndexError
 import redis
-from rabbitmq import RabbitMQ
+from redis.exceptions import WatchError
+from rabbitmq import RabbitMQ, shard_queue_name
 import copy
-
-from datetime import datetime
+from hashlib import sha1
+from prometheus_client import start_http_server
+from uuid import uuid4
 
 from config import Config
+from services import es_service, metrics, normalized_store
+from services.operations import applied_key, operation_ids, operation_key
+from services.plan_codec import PlanCodec
+from services.redis_scripts import DELETE_STALE_OBJECTS_SCRIPT, MERGE_PLAN_SCRIPT
 
 # Initialize Redis and Elasticsearch
-redis_client = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+redis_client = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+    host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB,
+    connection_class=metrics.InstrumentedConnection
+))
 es = Elasticsearch(
     [{'host': Config.ES_HOST, 'port': Config.ES_PORT, 'scheme': 'http'}],
     basic_auth=(Config.ES_USER, Config.ES_PASSWORD)
 )
+merge_plan = redis_client.register_script(MERGE_PLAN_SCRIPT)
+delete_stale_objects = redis_client.register_script(DELETE_STALE_OBJECTS_SCRIPT)
+plan_codec = PlanCodec(Config.PLAN_CODEC)
+
+# Redis or Elasticsearch being unreachable, read-only or out of memory is not the message's fault,
+# the batch is redelivered instead
+UNAVAILABLE = (ConnectionError, TimeoutError, redis.exceptions.ConnectionError, redis.exceptions.TimeoutError,
+               redis.exceptions.ReadOnlyError, redis.exceptions.OutOfMemoryError,
+               elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout)
+
+
+def retryable_status(status):
+    """Elasticsearch rejected a request because it is overloaded or failing, not because of the request."""
+    return status == 429 or status >= 500
+
+
+def unavailable(error):
+    """Whether `error` is transient, so the batch has to be redelivered rather than its message rejected."""
+    if isinstance(error, elasticsearch.ApiError):
+        return retryable_status(error.meta.status)
+    return isinstance(error, UNAVAILABLE)
+
+
+def etag_key(redis_key):
+    # plan:{id} -> etag:{id}, outside of the plan:* keyspace that is scanned for plans
+    return f"etag:{redis_key.split(':', 1)[1]}"
+
+
+def load_plan(redis_key, plan_data):
+    """Plan stored as `plan_data` under `redis_key`, in either storage layout."""
+    if normalized_store.is_normalized(plan_data):
+        return normalized_store.read(redis_client, redis_key.split(':', 1)[1])
+    return plan_codec.decode(plan_data)
+
+
+def write_plan(redis_key, document):
+    """
+    Redis write of a whole plan and its ETag in the configured storage layout, and that ETag.
+    Normalized objects of a previous version of the plan that the new one lacks are deleted.
+    """
+    if Config.PLAN_STORAGE == 'normalized':
+        etag = uuid4().hex
+        objects = normalized_store.flatten(document)
+
+        def write(pipeline):
+            delete_stale_objects(args=[document['objectId'], *objects], client=pipeline)
+            normalized_store.write(pipeline, document)
+            pipeline.set(redis_key, normalized_store.MARKER)
+            pipeline.set(etag_key(redis_key), etag)
+    else:
+        value = plan_codec.encode(document)
+        etag = sha1(value).hexdigest()
+
+        def write(pipeline):
+            # The plan may have been stored normalized before
+            delete_stale_objects(args=[document['objectId']], client=pipeline)
+            # Keep the plan's ETag next to it so conditional requests never load the plan
+            pipeline.set(redis_key, value)
+            pipeline.set(etag_key(redis_key), etag)
+    return write, etag
+
+
+def delete_plan(redis_key, object_ids=()):
+    """Redis write removing a plan, its ETag and the hashes of its normalized objects."""
+    def write(pipeline):
+        pipeline.delete(redis_key, etag_key(redis_key),
+                        *[normalized_store.object_key(object_id) for object_id in object_ids])
+    return write
+
+
+class WriteBatch:
+    """
+    Collects the Elasticsearch operations and Redis writes of several commands
+    so they are sent as one bulk request and one Redis pipeline.
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.redis_writes = {}
+        self.results = []
+        self._owners = {}
+
+    def pending(self, redis_key):
+        return redis_key in self.redis_writes
+
+    def add(self, redis_key, operations, write):
+        """Stage `operations` for Elasticsearch and `write(pipeline)` for the plan in Redis."""
+        self.add_operations(redis_key, operations)
+        self.redis_writes[redis_key] = write
+
+    def add_operations(self, redis_key, operations):
+        """Stage `operations` for Elasticsearch for a plan that is already written to Redis."""
+        for operation in operations:
+            for action in ('index', 'update', 'delete'):
+                if len(operation) == 1 and action in operation:
+                    self._owners[operation[action]['_id']] = redis_key
+        self.operations.extend(operations)
+
+    def add_result(self, redis_key, ids, result, committed=False):
+        """
+        Report `result` for operations `ids` once the batch is flushed. If an Elasticsearch
+        item of `redis_key` fails the result becomes failed, unless the write was `committed`
+        to Redis already.
+        """
+        if ids:
+            self.results.append((redis_key, ids, result, committed))
+
+    def flush(self):
+        """
+        Send the staged operations. Redis writes of plans with a failed
+        Elasticsearch item are skipped, the rest go out through one pipeline.
+        Items rejected with 429 or 5xx (e.g. es_rejected_execution) raise
+        ConnectionError before anything is written, so the batch is redelivered.
+        """
+        failed_keys = set()
+        try:
+            es_service.send_bulk(es, self.operations)
+        except BulkIndexError as e:
+            transient = [item for item in e.errors if retryable_status(next(iter(item.values()))['status'])]
+            if transient:
+                result = next(iter(transient[0].values()))
+                raise ConnectionError(f"Elasticsearch rejected {len(transient)} document(s) for now, "
+                                      f"e.g. {result['_id']}: {result['error']}") from e
+            for item in e.errors:
+                result = next(iter(item.values()))
+                failed_keys.add(self._owners.get(result['_id']))
+                print(f"Failed to write {result['_id']}: {result['error']}")
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for redis_key, write in self.redis_writes.items():
+            if redis_key in failed_keys:
+                print(f"Document {redis_key} not written to Redis.")
+                continue
+
+            write(pipeline)
+            # Tell the API workers to evict their cached copy
+            pipeline.publish(Config.PLAN_INVALIDATION_CHANNEL, redis_key.split(':', 1)[1])
+
+        # Results go out after the writes they report on, in the same round trip
+        for redis_key, ids, result, committed in self.results:
+            if redis_key in failed_keys and committed:
+                # The plan changed, only the search index is behind until the plan is reindexed
+                result = {**result, "error": "Saved, but Elasticsearch rejected the update of the search index"}
+            elif redis_key in failed_keys:
+                result = {**result, "status": "failed", "error": "Elasticsearch rejected the write"}
+            for operation_id in ids:
+                pipeline.set(operation_key(operation_id), json.dumps({"operation_id": operation_id, **result}),
+                             ex=Config.OPERATION_RESULT_TTL)
+                pipeline.publish(Config.OPERATION_CHANNEL, operation_id)
+        pipeline.execute()
+
+        self.operations = []
+        self.redis_writes = {}
+        self.results = []
+        self._owners = {}
 
 
 # Abstract Command class
 class Command(ABC):
-    def __init__(self, message):
+    def __init__(self, message, batch=None):
         self.message = message
+        self.batch = batch
 
-    @abstractmethod
     def execute(self):
+        metrics.start(type(self).__name__)
+        try:
+            batch = self.batch or WriteBatch()
+            self.stage(batch)
+            if self.batch is None:
+                batch.flush()
+        finally:
+            metrics.observe_command()
+
+    @abstractmethod
+    def stage(self, batch):
         pass
 
+    def complete(self, batch, redis_key, status="done", etag=None, error=None, committed=False):
+        """Report the outcome to clients waiting on this message's operations."""
+        batch.add_result(redis_key, operation_ids(self.message),
+                         {"action": self.message.get('action'), "status": status, "etag": etag, "error": error},
+                         committed)
+
 
 class CreateCommand(Command):
 
-    def execute(self):
+    def stage(self, batch):
         document = self.message['document']
         parent_id = document['objectId']
         redis_parent_id = f"plan:{parent_id}"
 
-        # Index parent document (Plan) in Elasticsearch
-        es.index(index='plans', id=parent_id, body={
-            "objectId": parent_id,
-            "org": document['org'],
-            "creationDate": datetime.utcnow(),
-            "objectType": document['objectType'],
-            "planType": document['planType'],
-            "join_field": {
-                "name": "plan"  # Define this as the parent type
-            }
-        })
-
-        # Index planCostShares as a child document in Elasticsearch
-        cost_shares_id = document['planCostShares']['objectId']
-        es.index(index='plans', id=cost_shares_id, routing=parent_id, body={
-            "objectId": cost_shares_id,
-            "deductible": document['planCostShares']['deductible'],
-            "copay": document['planCostShares']['copay'],
-            "org": document['planCostShares']['org'],
-            "objectType": document['planCostShares']['objectType'],
-            "join_field": {
-                "name": "planCostShares",
-                "parent": parent_id
-            }
-        })
-
-        # Index linkedPlanServices as child documents in Elasticsearch
-        for service in document['linkedPlanServices']:
-            service_id = service['objectId']
-            es.index(index='plans', id=service_id, routing=parent_id, body={
-                "objectId": service_id,
-                "org": service['org'],
-                "objectType": service['objectType'],
-                "join_field": {
-                    "name": "linkedPlanServices",
-                    "parent": parent_id
-                }
-            })
-
-            # Handle nested children (linkedService and planserviceCostShares)
-            linked_service_id = service['linkedService']['objectId']
-            planservice_cost_shares_id = service['planserviceCostShares']['objectId']
-
-            # Index linkedService (Child of linkedPlanServices)
-            es.index(index='plans', id=linked_service_id, routing=service_id, body={
-                "objectId": linked_service_id,
-                "name": service['linkedService']['name'],
-                "org": service['linkedService']['org'],
-                "objectType": service['linkedService']['objectType'],
-                "join_field": {
-                    "name": "linkedService",
-                    "parent": service_id
-                }
-            })
-
-            # Index planserviceCostShares (Child of linkedPlanServices)
-            es.index(index='plans', id=planservice_cost_shares_id, routing=service_id, body={
-                "objectId": planservice_cost_shares_id,
-                "deductible": service['planserviceCostShares']['deductible'],
-                "copay": service['planserviceCostShares']['copay'],
-                "org": service['planserviceCostShares']['org'],
-                "objectType": service['planserviceCostShares']['objectType'],
-                "join_field": {
-                    "name": "planserviceCostShares",
-                    "parent": service_id
-                }
-            })
-
-        # Save the entire document to Redis
-        redis_client.set(redis_parent_id, json.dumps(document))
-
-        print(f"Document {parent_id} created successfully.")
+        # Index the plan and all of its join children, then save the entire document to Redis
+        write, etag = write_plan(redis_parent_id, document)
+        batch.add(redis_parent_id, es_service.plan_to_operations(document), write)
+        self.complete(batch, redis_parent_id, etag=etag)
 
 
 # Concrete Command class for Patch operation
 class PatchCommand(Command):
-    def execute(self):
+    def stage(self, batch):
         new_plan = self.message['document']
         parent_id = new_plan['objectId']
         parent_redis_key = f"plan:{parent_id}"
 
-        try:
-            # Retrieve the current plan from Redis and Elasticsearch
-            try:
-                current_plan = json.loads(redis_client.get(parent_redis_key))
-            except (TypeError, json.JSONDecodeError):
-                current_plan = {}
-
-            try:
-                es_current_plan = es.get(index='plans', id=parent_id)['_source']
-            except NotFoundError:
-                print(f"Plan document {parent_id} not found in Elasticsearch.")
-                return
-
-            # Merge new plan data with existing data
-            merged_plan = self.merge_records(current_plan, new_plan)
-
-            # Update Redis with merged record
-            redis_client.set(parent_redis_key, json.dumps(merged_plan))
-
-            # Update only the parent plan in Elasticsearch
-            es.update(index='plans', id=parent_id, body={"doc": {
-                "org": new_plan.get('org', es_current_plan['org']),
-                "objectType": new_plan.get('objectType', es_current_plan['objectType']),
-                "planType": new_plan.get('planType', es_current_plan['planType']),
-            }})
-
-            # Update or create child documents in Elasticsearch
-            if new_plan.get('planCostShares'):
-                cost_shares_id = new_plan['planCostShares']['objectId']
-                es.update(index='plans', id=cost_shares_id, routing=parent_id, body={"doc": new_plan['planCostShares']})
-
-            existing_child_ids = {item['objectId'] for item in current_plan.get('linkedPlanServices', [])}
-
-            for service in new_plan.get('linkedPlanServices', []):
-                service_id = service['objectId']
-
-                # Update or create the linkedPlanServices in Elasticsearch
-                if service_id in existing_child_ids:
-                    pass
-                else:
-                    es.index(index='plans', id=service_id, routing=parent_id, body={
-                        "objectId": service['objectId'],
-                        "org": service['org'],
-                        "objectType": service['objectType'],
-                        "join_field": {
-                            "name": "linkedPlanServices",
-                            "parent": parent_id
-                        }
-                    })
-
-                    # Handle the children of linkedPlanServices
-                    if 'linkedService' in service:
-                        linked_service = service['linkedService']
-                        es.index(index='plans', id=linked_service['objectId'], routing=service_id, body={
-                            **linked_service,
-                            "join_field": {
-                                "name": "linkedService",
-                                "parent": service_id
-                            }
-                        })
-
-                    if 'planserviceCostShares' in service:
-                        cost_shares = service['planserviceCostShares']
-                        es.index(index='plans', id=cost_shares['objectId'], routing=service_id, body={
-                            **cost_shares,
-                            "join_field": {
-                                "name": "planserviceCostShares",
-                                "parent": service_id
-                            }
-                        })
-
-            print(f"Document {parent_id} patched successfully.")
-
-        except (ConnectionError, TimeoutError) as e:
-            print(f"Error occurred: {e}")
-            raise e
+        # The merge runs against Redis itself, so earlier writes in the batch must land first
+        if batch.pending(parent_redis_key):
+            batch.flush()
+
+        # Merge new plan data with existing data and update its ETag in one atomic call
+        marker = self.applied_marker()
+        status = b'unsupported'
+        if not plan_codec.compressed:
+            keys = [parent_redis_key, etag_key(parent_redis_key)] + ([marker] if marker else [])
+            status, *result = merge_plan(keys=keys,
+                                         args=[json.dumps(new_plan), self.message.get('etag') or '',
+                                               Config.PLAN_INVALIDATION_CHANNEL, parent_id, plan_codec.name,
+                                               Config.OPERATION_RESULT_TTL])
+            if status == b'ok':
+                result = [result[0], plan_codec.decode(result[1]), plan_codec.decode(result[2])]
+        if status == b'unsupported':
+            # Lua cannot decompress or assemble normalized plans, merge in an optimistic transaction instead
+            status, *result = self.merge_in_transaction(parent_redis_key, new_plan)
+
+        if status == b'applied':
+            return self.restage(batch, parent_redis_key, result[0])
+        if status == b'missing':
+            print(f"Plan document {parent_id} not found.")
+            self.complete(batch, None, status="failed", error="Plan not found")
+            return
+        if status == b'conflict':
+            print(f"Plan document {parent_id} changed since ETag {self.message.get('etag')}, patch rejected.")
+            self.complete(batch, None, status="failed", error="Plan changed since the patch's ETag")
+            return
+
+        new_etag, current_plan, merged_plan = result
+
+        # Sync only the join documents that actually changed to Elasticsearch
+        operations = es_service.diff_operations(current_plan, merged_plan)
+        batch.add_operations(parent_redis_key, operations)
+        if isinstance(new_etag, bytes):
+            new_etag = new_etag.decode('utf-8')
+        self.complete(batch, parent_redis_key, etag=new_etag, committed=True)
+
+    def applied_marker(self):
+        """Key marking this message's patch as applied, None for messages without an operation."""
+        ids = operation_ids(self.message)
+        return applied_key(ids[0]) if ids else None
+
+    def restage(self, batch, redis_key, etag):
+        """
+        A redelivered patch that is already merged into Redis, the batch that applied it
+        failed before Elasticsearch got the change. Reindex the plan as Redis has it.
+        """
+        print(f"Patch of {redis_key} was applied before, only reindexing it.")
+        plan_data = redis_client.get(redis_key)
+        plan = load_plan(redis_key, plan_data) if plan_data else None
+        if plan:
+            batch.add_operations(redis_key, es_service.plan_to_operations(plan))
+        self.complete(batch, redis_key, etag=etag.decode('utf-8'), committed=True)
+
+    def merge_in_transaction(self, parent_redis_key, new_plan):
+        """
+        Same contract as MERGE_PLAN_SCRIPT, with WATCH/MULTI around a merge in Python.
+        Every write to a plan also sets its ETag, so watching the ETag covers normalized objects.
+        """
+        marker = self.applied_marker()
+        with redis_client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(parent_redis_key, etag_key(parent_redis_key))
+                    current, etag, applied = pipeline.mget(parent_redis_key, etag_key(parent_redis_key),
+                                                           marker or etag_key(parent_redis_key))
+                    if marker and applied:
+                        return [b'applied', applied]
+                    if current is None:
+                        return [b'missing']
+                    expected_etag = self.message.get('etag')
+                    if expected_etag and etag and etag.decode('utf-8') != expected_etag:
+                        return [b'conflict', etag]
+
+                    current_plan = load_plan(parent_redis_key, current)
+                    if current_plan is None:
+                        return [b'missing']
+                    merged_plan = self.merge_records(copy.deepcopy(current_plan), new_plan)
+                    pipeline.multi()
+                    if normalized_store.is_normalized(current):
+                        # Only the hashes of the objects the patch changed are written
+                        normalized_store.write_diff(pipeline, current_plan, merged_plan)
+                        new_etag = uuid4().hex
+                    else:
+                        merged = plan_codec.encode(merged_plan)
+                        new_etag = sha1(merged).hexdigest()
+                        pipeline.set(parent_redis_key, merged)
+                    pipeline.set(etag_key(parent_redis_key), new_etag)
+                    if marker:
+                        pipeline.set(marker, new_etag, ex=Config.OPERATION_RESULT_TTL)
+                    pipeline.publish(Config.PLAN_INVALIDATION_CHANNEL, new_plan['objectId'])
+                    pipeline.execute()
+                    return [b'ok', new_etag, current_plan, merged_plan]
+                except WatchError:
+                    continue
 
     def merge_records(self, existing_record, new_record):
-        # Deep copy of the existing record to avoid modifying it directly
-        merged_record = copy.deepcopy(existing_record)
+        # Mirrors the merge of MERGE_PLAN_SCRIPT: None fields of the patch are ignored
+        merged_record = existing_record
 
         # Merge planCostShares
         if new_record.get('planCostShares'):
-            merged_record['planCostShares'] = new_record['planCostShares']
+            cost_shares = merged_record.setdefault('planCostShares', {})
+            cost_shares.update({key: value for key, value in new_record['planCostShares'].items() if value is not None})
 
         # Merge linkedPlanServices
         if new_record.get('linkedPlanServices'):
-            if 'linkedPlanServices' not in merged_record:
-                merged_record['linkedPlanServices'] = []
-
-            existing_services = {item['objectId']: item for item in merged_record['linkedPlanServices']}
+            existing_services = {item['objectId']: item for item in merged_record.setdefault('linkedPlanServices', [])}
             for item in new_record['linkedPlanServices']:
-                if item['objectId'] in existing_services:
-                    # Merge the existing service
-                    existing_service = existing_services[item['objectId']]
-                    existing_service.update(item)
-                else:
+                existing_service = existing_services.get(item['objectId'])
+                if existing_service is None:
                     # Append new service
                     merged_record['linkedPlanServices'].append(item)
+                    continue
+                for key, value in item.items():
+                    if key in ('linkedService', 'planserviceCostShares') and value and existing_service.get(key):
+                        existing_service[key].update({k: v for k, v in value.items() if v is not None})
+                    elif value is not None:
+                        existing_service[key] = value
 
         # Merge other top-level fields
         for field in ['objectType', 'planType', 'org', 'creationDate']:
@@ -224,82 +361,96 @@ class PatchCommand(Command):
         return merged_record
 
 
+class PatchServiceCommand(PatchCommand):
+    """
+    Patch of a single linkedPlanServices item. For normalized plans only that
+    service's objects are read and written, otherwise it is a regular plan patch.
+    """
+
+    def stage(self, batch):
+        plan_id = self.message['plan_id']
+        service = self.message['document']
+        redis_key = f"plan:{plan_id}"
+
+        if batch.pending(redis_key):
+            batch.flush()
+
+        plan_data = redis_client.get(redis_key)
+        if plan_data is None:
+            print(f"Plan document {plan_id} not found.")
+            self.complete(batch, None, status="failed", error="Plan not found")
+            return
+        if not normalized_store.is_normalized(plan_data):
+            # A plan patch would append an unknown service, this endpoint only updates existing ones.
+            # Every write of the plan goes through this consumer, so it still exists for the merge.
+            services = plan_codec.decode(plan_data).get('linkedPlanServices') or []
+            if not any(item['objectId'] == service['objectId'] for item in services):
+                print(f"Service {service['objectId']} of plan {plan_id} not found.")
+                self.complete(batch, None, status="failed", error="Service not found")
+                return
+            self.message = {**self.message, 'document': {'objectId': plan_id, 'linkedPlanServices': [service]}}
+            return super().stage(batch)
+
+        marker = self.applied_marker()
+        with redis_client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(etag_key(redis_key))
+                    etag, applied = pipeline.mget(etag_key(redis_key), marker or etag_key(redis_key))
+                    if marker and applied:
+                        return self.restage(batch, redis_key, applied)
+                    expected_etag = self.message.get('etag')
+                    if expected_etag and etag and etag.decode('utf-8') != expected_etag:
+                        print(f"Plan document {plan_id} changed since ETag {expected_etag}, patch rejected.")
+                        self.complete(batch, None, status="failed", error="Plan changed since the patch's ETag")
+                        return
+
+                    current_service = normalized_store.read(redis_client, service['objectId'], parent_id=plan_id)
+                    if current_service is None:
+                        print(f"Service {service['objectId']} of plan {plan_id} not found.")
+                        self.complete(batch, None, status="failed", error="Service not found")
+                        return
+                    merged_service = self.merge_records({'linkedPlanServices': [copy.deepcopy(current_service)]},
+                                                        {'linkedPlanServices': [service]})['linkedPlanServices'][0]
+
+                    new_etag = uuid4().hex
+                    pipeline.multi()
+                    normalized_store.write_diff(pipeline, current_service, merged_service, parent_id=plan_id)
+                    pipeline.set(etag_key(redis_key), new_etag)
+                    if marker:
+                        pipeline.set(marker, new_etag, ex=Config.OPERATION_RESULT_TTL)
+                    pipeline.publish(Config.PLAN_INVALIDATION_CHANNEL, plan_id)
+                    pipeline.execute()
+                    break
+                except WatchError:
+                    continue
+
+        batch.add_operations(redis_key, es_service.service_diff_operations(current_service, merged_service, plan_id))
+        self.complete(batch, redis_key, etag=new_etag, committed=True)
+
+
 class DeleteCommand(Command):
-    def execute(self):
+    def stage(self, batch):
         doc_id = self.message['doc_id']
         redis_key = f"plan:{doc_id}"
 
-        print("Check for childs...")
-        try:
-            # Delete child documents of the parent (linkedPlanServices)
-            query_linked_plan_services = {
-                "query": {
-                    "has_parent": {
-                        "parent_type": "plan",
-                        "query": {
-                            "term": {
-                                "objectId": doc_id
-                            }
-                        }
-                    }
-                }
-            }
-            linked_plan_services_docs = es.search(index='plans', body=query_linked_plan_services, size=1000)
-
-            for linked_plan_service in linked_plan_services_docs['hits']['hits']:
-                linked_service_id = linked_plan_service['_id']
-
-                # Delete children of linkedPlanServices
-                query_linked_service_children = {
-                    "query": {
-                        "has_parent": {
-                            "parent_type": "linkedPlanServices",
-                            "query": {
-                                "term": {
-                                    "objectId": linked_service_id
-                                }
-                            }
-                        }
-                    }
-                }
-                linked_service_children_docs = es.search(index='plans', body=query_linked_service_children, size=1000)
-
-                for child_doc in linked_service_children_docs['hits']['hits']:
-                    child_id = child_doc['_id']
-                    try:
-                        if es.exists(index='plans', id=child_id):
-                            es.delete(index='plans', id=child_id)
-                            print(f"Nested child document {child_id} deleted from Elasticsearch.")
-                    except Exception as e:
-                        print(f"Failed to delete nested child document {child_id} from Elasticsearch: {e}")
-
-                # Delete the linkedPlanServices document itself
-                try:
-                    if es.exists(index='plans', id=linked_service_id):
-                        es.delete(index='plans', id=linked_service_id)
-                        print(f"Child document {linked_service_id} deleted from Elasticsearch.")
-                except Exception as e:
-                    print(f"Failed to delete linkedPlanServices document {linked_service_id} from Elasticsearch: {e}")
-
-            try:
-                # Delete parent document from Elasticsearch if it exists
-                if es.exists(index='plans', id=doc_id):
-                    es.delete(index='plans', id=doc_id)
-                    print(f"Parent document {doc_id} deleted from Elasticsearch.")
-                else:
-                    print(f"Parent document {doc_id} does not exist in Elasticsearch.")
-            except Exception as e:
-                print(f"Failed to delete parent document {doc_id} from Elasticsearch: {e}")
-
-            # Delete parent document from Redis if it exists
-            if redis_client.exists(redis_key):
-                redis_client.delete(redis_key)
-                print(f"Parent document {doc_id} deleted from Redis.")
-            else:
-                print(f"Parent document {redis_key} does not exist in Redis.")
+        if batch.pending(redis_key):
+            batch.flush()
 
-        except Exception as e:
-            print(f"Failed to query or delete child documents from Elasticsearch: {e}")
+        # Collect descendants from the Redis copy, falling back to Elasticsearch
+        plan_data = redis_client.get(redis_key)
+        plan = load_plan(redis_key, plan_data) if plan_data else None
+        if plan:
+            child_ids = es_service.plan_child_ids(plan)
+        else:
+            print(f"Parent document {redis_key} does not exist in Redis, searching for childs...")
+            child_ids = es_service.search_child_ids(es, doc_id)
+
+        # Delete every descendant and the parent, then the Redis copy
+        object_ids = child_ids + [doc_id] if plan_data and normalized_store.is_normalized(plan_data) else []
+        batch.add(redis_key, es_service.delete_operations(child_ids + [doc_id], routing=doc_id),
+                  delete_plan(redis_key, object_ids))
+        self.complete(batch, redis_key)
 
 
 # Invoker class
@@ -308,25 +459,167 @@ class CommandInvoker:
         self._commands = {
             "create": CreateCommand,
             "patch": PatchCommand,
+            "patch_service": PatchServiceCommand,
             "delete": DeleteCommand
         }
 
-    def invoke(self, message):
+    def invoke(self, message, batch=None):
         action = message.get("action")
         command_class = self._commands.get(action)
         if command_class:
-            command = command_class(message)
+            command = command_class(message, batch)
             command.execute()
         else:
             print(f"Unknown operation: {action}")
 
 
 def callback(ch, method, properties, body):
-    print(f"Received new message")
     message = json.loads(body)
     invoker = CommandInvoker()
     invoker.invoke(message)
 
 
-rabbitmq = RabbitMQ()
-rabbitmq.consume(callback=callback, queue_name='medical_plan')
+def message_plan_id(message):
+    action = message.get('action')
+    if action in ('create', 'patch'):
+        return message['document']['objectId']
+    if action == 'patch_service':
+        return message['plan_id']
+    return message.get('doc_id')
+
+
+def _inherit(message, others, deliveries):
+    """`message` takes over the deliveries (queue message indexes by id()) and superseded operations of `others`."""
+    for other in others:
+        if other.get('superseded'):
+            message.setdefault('superseded', []).extend(other.pop('superseded'))
+        if deliveries is not None:
+            deliveries.setdefault(id(message), []).extend(deliveries.pop(id(other), []))
+
+
+def absorb(message, others, deliveries=None):
+    """Make `message` complete the operations of the `others` folded into it, as its own."""
+    ids = operation_ids(message) + [operation_id for other in others for operation_id in operation_ids(other)]
+    if ids:
+        message['operation_ids'] = ids
+    _inherit(message, others, deliveries)
+
+
+def supersede(message, others, deliveries=None):
+    """
+    Make `message` report the `others` it made moot as superseded, each with its own
+    action, so a client never sees the outcome of a different write as its own.
+    """
+    for other in others:
+        if operation_ids(other):
+            message.setdefault('superseded', []).append({"action": other.get('action'),
+                                                         "operation_ids": operation_ids(other)})
+    _inherit(message, others, deliveries)
+
+
+def complete_superseded(batch, message):
+    for superseded in message.get('superseded', ()):
+        batch.add_result(None, superseded['operation_ids'],
+                         {"action": superseded['action'], "status": "superseded", "etag": None, "error": None})
+
+
+def coalesce(messages, deliveries=None):
+    """
+    Drop the messages of one batch that later creates and deletes of the same plan make moot.
+
+    A create or delete makes the patches and creates queued ahead of it moot, their
+    operations complete as superseded. A delete right after another one is dropped and
+    completes with it. Patches are never folded into each other: every patch from the
+    API carries the ETag it was made against and has to be checked on its own.
+    Messages of one plan keep their order. `deliveries` maps id() of each message to
+    the indexes of the queue messages behind it and is kept up to date.
+    """
+    plans = {}
+    for message in messages:
+        plan_id = message_plan_id(message)
+        if plan_id is None:
+            plans[id(message)] = [message]
+            continue
+        queued = plans.setdefault(plan_id, [])
+        action = message.get('action')
+
+        if action in ('create', 'delete'):
+            superseded = [m for m in queued if m.get('action') != 'delete']
+            queued[:] = [m for m in queued if m.get('action') == 'delete']
+            if action == 'delete' and queued:
+                # Already deleted, this delete's operations complete with the earlier one
+                absorb(queued[-1], [message], deliveries)
+                supersede(queued[-1], superseded, deliveries)
+                continue
+            supersede(message, superseded, deliveries)
+        queued.append(message)
+
+    coalesced = [message for queued in plans.values() for message in queued]
+    metrics.COALESCED_MESSAGES.inc(len(messages) - len(coalesced))
+    return coalesced
+
+
+def batch_callback(bodies):
+    """
+    Apply a batch of queue messages, returns the indexes of the ones that could not be
+    applied. A malformed message or one whose command fails for good (a missing field,
+    a 4xx from Elasticsearch) is logged and rejected on its own. Transient errors of
+    Redis or Elasticsearch (see `unavailable`) are raised for the whole batch.
+    """
+    invoker = CommandInvoker()
+    batch = WriteBatch()
+    rejected = []
+    messages = []
+    deliveries = {}
+    for index, body in enumerate(bodies):
+        try:
+            message = json.loads(body)
+            message_plan_id(message)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Rejecting malformed message {body[:200]!r}: {e!r}")
+            rejected.append(index)
+            continue
+        messages.append(message)
+        deliveries[id(message)] = [index]
+
+    if Config.CONSUMER_COALESCE:
+        messages = coalesce(messages, deliveries)
+    for message in messages:
+        try:
+            invoker.invoke(message, batch)
+            complete_superseded(batch, message)
+        except Exception as e:
+            if unavailable(e):
+                raise
+            print(f"Rejecting message {message.get('action')} of {message_plan_id(message)}: {e!r}")
+            rejected.extend(deliveries.get(id(message), []))
+            batch.add_result(None, operation_ids(message),
+                             {"action": message.get('action'), "status": "failed", "etag": None, "error": str(e)})
+            complete_superseded(batch, message)
+
+    metrics.start('flush')
+    try:
+        batch.flush()
+    finally:
+        metrics.observe_command()
+    return sorted(rejected)
+
+
+if __name__ == '__main__':
+    # Each consumer process owns one shard queue: `python consumer.py <shard>`
+    shard = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    try:
+        queue_name = shard_queue_name(shard)
+    except ValueError as e:
+        # With QUEUE_SHARDS=1 every shard would silently consume the one unsharded queue
+        sys.exit(str(e))
+    # One metrics port per shard so consumers on the same host do not collide
+    start_http_server(Config.CONSUMER_METRICS_PORT + shard)
+
+    rabbitmq = RabbitMQ()
+    rabbitmq.channel.queue_declare(queue=queue_name, durable=True)
+    rabbitmq.consume_batches(queue_name=queue_name,
+                             callback=batch_callback,
+                             prefetch_count=Config.CONSUMER_PREFETCH_COUNT,
+                             batch_size=Config.CONSUMER_BATCH_SIZE,
+                             max_wait=Config.CONSUMER_BATCH_WAIT)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel, validator, Field
+from pydantic import BaseModel, Field
 
 
 class PlanCostShares(BaseModel):
@@ -36,7 +36,8 @@ class LinkedPlanServiceItem(BaseModel):
 
 class PlanSchema(BaseModel):
     planCostShares: PlanCostShares
-    linkedPlanServices: List[LinkedPlanServiceItem]
+    # Enforced by the compiled validator, also when validating raw JSON
+    linkedPlanServices: List[LinkedPlanServiceItem] = Field(min_length=1)
     org: str
     objectId: str
     objectType: str
@@ -50,17 +51,6 @@ class PlanSchema(BaseModel):
             "$id": "http://example.com/root.json"
         }
 
-    @classmethod
-    def validate_linkedPlanServices(cls, v):
-        if len(v) < 1:
-            raise ValueError('linkedPlanServices must contain at least one item')
-        return v
-
-    @classmethod
-    def __get_validators__(cls):
-        yield from super().__get_validators__()
-        yield cls.validate_linkedPlanServices
-
 # TODO: Better way to create partial models
 # def create_partial_model(name: str, model: BaseModel) -> BaseModel:
 #     fields = {}
@@ -117,20 +107,9 @@ class PatchLinkedPlanServiceItem(BaseModel):
 
 class PatchPlanSchema(BaseModel):
     planCostShares: Optional[PatchPlanCostShares] = None
-    linkedPlanServices: Optional[List[PatchLinkedPlanServiceItem]] = None
+    linkedPlanServices: Optional[List[PatchLinkedPlanServiceItem]] = Field(None, min_length=1)
     org: Optional[str] = None
     objectId: str
     objectType: Optional[str] = None
     planType: Optional[str] = None
     creationDate: Optional[datetime] = None
-
-    @classmethod
-    def validate_linkedPlanServices(cls, v):
-        if v is not None and len(v) < 1:
-            raise ValueError('linkedPlanServices must contain at least one item')
-        return v
-
-    @classmethod
-    def __get_validators__(cls):
-        yield from super().__get_validators__()
-        yield cls.validate_linkedPlanServices
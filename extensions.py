@@ -1,16 +1,40 @@
-import pika
+from elasticsearch import Elasticsearch
 from flask_redis import FlaskRedis
+from services.client_registry import ClientRegistry
 from services.google_auth import GoogleAuth
+from services.metrics import InstrumentedConnection
+from services.operations import OperationWaiter
+from services.plan_cache import PlanCache
+from services.plan_codec import PlanCodec
+from rabbitmq import Publisher, shard_queue_name
 
 import config
 
 config = config.Config()
-redis_client = FlaskRedis()
+redis_client = FlaskRedis(connection_class=InstrumentedConnection)
+plan_codec = PlanCodec(config.PLAN_CODEC)
+plan_cache = PlanCache(max_bytes=config.PLAN_CACHE_MAX_BYTES, channel=config.PLAN_INVALIDATION_CHANNEL)
+operation_waiter = OperationWaiter(channel=config.OPERATION_CHANNEL)
 
-# Instantiate the GoogleAuth class
-google_auth = GoogleAuth(config.GOOGLE_CLIENT_ID)
+# Created on first use in each process, see `init_clients`
+clients = ClientRegistry()
+es = clients.proxy('es')
+google_auth = clients.proxy('google_auth')
+publisher = clients.proxy('publisher')
 
-# RabbitMQ setup
-connection = pika.BlockingConnection(pika.ConnectionParameters(host=config.RABBITMQ_HOST, port=config.RABBITMQ_PORT))
-channel = connection.channel()
-channel.queue_declare(queue='medical_plan')
+
+def init_clients(app):
+    """Register the client factories of `app`, none of them runs before a client is used."""
+    settings = app.config
+    clients.register('es', lambda: Elasticsearch(
+        [{'host': settings['ES_HOST'], 'port': settings['ES_PORT'], 'scheme': 'http'}],
+        basic_auth=(settings['ES_USER'], settings['ES_PASSWORD'])
+    ))
+    clients.register('google_auth', lambda: GoogleAuth(settings['GOOGLE_CLIENT_ID'],
+                                                       token_cache_size=settings['AUTH_TOKEN_CACHE_SIZE'],
+                                                       token_cache_ttl=settings['AUTH_TOKEN_CACHE_TTL']))
+    # RabbitMQ setup, safe to share between request threads
+    clients.register('publisher', lambda: Publisher(
+        queues=[shard_queue_name(shard) for shard in range(settings['QUEUE_SHARDS'])]
+    ))
+    app.extensions['clients'] = clients
@@ -1,12 +1,16 @@
 import json
+from uuid import uuid4
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from pydantic import ValidationError
 
-from data_models.medical_plan import PlanSchema, PatchPlanSchema
-from services import redis_service
+from config import Config
+from data_models.medical_plan import PlanSchema, PatchPlanSchema, PatchLinkedPlanServiceItem
+from services import es_service, json_stream, metrics, redis_service
+from services.operations import requested_wait
+from rabbitmq import queue_for, queue_message
 
-from extensions import google_auth, channel
+from extensions import google_auth, publisher, operation_waiter, es
 
 api_bp = Blueprint('api', __name__)
 
@@ -16,6 +20,17 @@ def health_check():
     return "Hello"
 
 
+@api_bp.before_request
+def start_request_metrics():
+    metrics.start(request.url_rule.rule if request.url_rule else 'unmatched')
+
+
+@api_bp.after_request
+def observe_request_metrics(response):
+    metrics.observe_request(request.method, response.status_code)
+    return response
+
+
 @api_bp.before_request
 def before_request_func():
     auth_header = request.headers.get('Authorization')
@@ -24,47 +39,128 @@ def before_request_func():
 
     token = auth_header.split(" ")[1]
 
-    decoded_token = google_auth.verify_token(token)
+    with metrics.track('auth'):
+        decoded_token = google_auth.verify_token(token)
     if not decoded_token:
         return jsonify({"message": "Token is invalid!"}), 401
 
 
+def _wait_seconds():
+    return requested_wait(request.headers.get('Prefer'), request.args.get('wait'), Config.OPERATION_MAX_WAIT)
+
+
+def _queued(operation_id, action, message, status, done_status=200):
+    """
+    Response to a queued write. Clients that asked to wait get the outcome instead
+    if the consumer applied the write in time, with the plan's new ETag. A write that
+    failed or was superseded by a later one is a 409.
+    """
+    wait = _wait_seconds()
+    headers = {'Location': f"/v1/operations/{operation_id}"}
+    if wait:
+        headers['Preference-Applied'] = f"wait={wait}"
+        result = operation_waiter.wait(operation_id, wait)
+        if result is not None:
+            if result.get('etag'):
+                headers['ETag'] = result['etag']
+            applied = result['status'] == 'done' and result.get('action') == action
+            return jsonify(result), done_status if applied else 409, headers
+    return jsonify({"message": message, "operation_id": operation_id}), status, headers
+
+
 @api_bp.route('/v1/plan', methods=['POST'])
 def create_plan():
     try:
-        plan_schema = PlanSchema(**request.json)
-        # Publish to RabbitMQ
-        req = {"action": "create", "document": plan_schema.dict()}
-        channel.basic_publish(exchange='',
-                              routing_key='medical_plan',
-                              body=json.dumps(req))
+        # Validated straight from the request bytes, the canonical JSON is published as is
+        plan_schema = PlanSchema.model_validate_json(request.get_data())
+        operation_id = uuid4().hex
+        publisher.publish(queue_for(plan_schema.objectId),
+                          queue_message("create", plan_schema.model_dump_json().encode('utf-8'),
+                                        operation_id=operation_id))
 
-        return jsonify({"message": "Document queued for processing"}), 202
+        return _queued(operation_id, "create", "Document queued for processing", 202, done_status=201)
 
     except ValidationError as e:
-        return jsonify(e.errors()), 400
+        return Response(e.json(), status=400, mimetype='application/json')
     except ValueError as e:
         return jsonify({'error': str(e)}), 409
     except (ConnectionError, TimeoutError) as e:
         return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
 
 
+def _ingest(items):
+    """
+    Validate (line, raw plan) items one at a time and publish the valid ones every
+    INGEST_BATCH_SIZE items, yielding the NDJSON report of each batch.
+    """
+    counts = {"queued": 0, "invalid": 0, "failed": 0}
+    results = []
+    messages = []
+
+    def flush():
+        if messages:
+            try:
+                publisher.publish_many(messages)
+            except (ConnectionError, TimeoutError) as e:
+                for result in results:
+                    if result["status"] == "queued":
+                        result.update(status="failed", error=str(e))
+        report = b""
+        for result in results:
+            counts[result["status"]] += 1
+            report += json.dumps(result).encode('utf-8') + b"\n"
+        results.clear()
+        messages.clear()
+        return report
+
+    for line, item in items:
+        try:
+            plan = PlanSchema.model_validate_json(item)
+            messages.append((queue_for(plan.objectId),
+                             queue_message("create", plan.model_dump_json().encode('utf-8'))))
+            results.append({"line": line, "objectId": plan.objectId, "status": "queued"})
+        except ValidationError as e:
+            results.append({"line": line, "status": "invalid",
+                            "errors": e.errors(include_url=False, include_input=False)})
+        if len(results) >= Config.INGEST_BATCH_SIZE:
+            yield flush()
+
+    yield flush()
+    yield json.dumps({"summary": counts}).encode('utf-8') + b"\n"
+
+
+@api_bp.route('/v1/plans:batch', methods=['POST'])
+def create_plans_batch():
+    # The body is read while the report streams out, it is never held in memory as a whole
+    if request.mimetype == 'application/x-ndjson':
+        items = json_stream.iter_ndjson(request.stream)
+    else:
+        # The "line" of an array element is its position in the array
+        items = enumerate(json_stream.iter_json_array(request.stream), start=1)
+    return Response(stream_with_context(_ingest(items)), mimetype='application/x-ndjson')
+
+
 @api_bp.route('/v1/plan/<object_id>', methods=['GET'])
 def get_plan(object_id):
     try:
-        plan, etag = redis_service.get_plan(object_id)
-
         # Get the provided If-None-Match header from the request
         if_none_match = request.headers.get('If-None-Match')
 
-        if plan:
-            # Compare the If-None-Match header with the plan's ETag
-            if if_none_match == etag:
-                # If the ETags match, return 304 Not Modified
-                return '', 304
-            else:
-                # If the ETags don't match, return the plan with updated ETag
+        # Revalidation only needs the stored ETag, not the plan itself
+        if if_none_match and if_none_match == redis_service.get_etag(object_id):
+            return '', 304
+
+        if Config.VALIDATE_PLAN_READS:
+            # Debug/migration mode: round trip the stored plan through the schema
+            plan, etag = redis_service.get_plan(object_id)
+            if plan:
                 return jsonify(plan.dict()), 200, {'ETag': etag}
+            return jsonify({'error': 'Plan not found'}), 404
+
+        # Plans were validated on write, serve the stored bytes as they are
+        plan_data, etag = redis_service.get_raw_plan(object_id)
+        if plan_data:
+            return Response(plan_data, status=200, mimetype='application/json', headers={'ETag': etag})
         else:
             return jsonify({'error': 'Plan not found'}), 404
     except (ConnectionError, TimeoutError) as e:
@@ -74,12 +170,11 @@ def get_plan(object_id):
 @api_bp.route('/v1/plan/<object_id>', methods=['DELETE'])
 def delete_plan(object_id):
     try:
-        req = {"action": "delete", "doc_id": object_id}
-        channel.basic_publish(exchange='',
-                              routing_key='medical_plan',
-                              body=json.dumps(req))
+        operation_id = uuid4().hex
+        req = {"action": "delete", "doc_id": object_id, "operation_id": operation_id}
+        publisher.publish(queue_for(object_id), json.dumps(req))
 
-        return jsonify({"message": "request queued for processing"}), 200
+        return _queued(operation_id, "delete", "request queued for processing", 200)
 
     except ValidationError as e:
         return jsonify(e.errors()), 400
@@ -89,11 +184,70 @@ def delete_plan(object_id):
         return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
 
 
+def _stream_ndjson(plans):
+    for plan_data in plans:
+        yield plan_data + b"\n"
+
+
+def _stream_json_array(plans):
+    separator = b"["
+    for plan_data in plans:
+        yield separator + plan_data
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
 @api_bp.route('/v1/plans', methods=['GET'])
 def get_all_plans():
     try:
-        plans = redis_service.get_all_plans()
-        return jsonify([plan.dict() for plan in plans]), 200
+        if request.args.get('stream') == 'true':
+            # Export the whole catalog as the stored bytes, one SCAN page at a time
+            plans = redis_service.iter_raw_plans(Config.PLANS_PAGE_SIZE)
+            if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+                return Response(stream_with_context(_stream_ndjson(plans)), mimetype='application/x-ndjson')
+            return Response(stream_with_context(_stream_json_array(plans)), mimetype='application/json')
+
+        cursor = request.args.get('cursor', 0, type=int)
+        limit = request.args.get('limit', Config.PLANS_PAGE_SIZE, type=int)
+        if cursor < 0 or not 0 < limit <= Config.PLANS_MAX_PAGE_SIZE:
+            return jsonify({'error': f'cursor must be >= 0 and limit between 1 and {Config.PLANS_MAX_PAGE_SIZE}'}), 400
+
+        plans, next_cursor = redis_service.get_all_plans(cursor, limit)
+        return jsonify({
+            "plans": [plan.dict() for plan in plans],
+            "next_cursor": next_cursor or None
+        }), 200
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/plans/search', methods=['GET'])
+def search_plans():
+    try:
+        size = request.args.get('size', Config.PLANS_PAGE_SIZE, type=int)
+        if not 0 < size <= Config.PLANS_MAX_PAGE_SIZE:
+            return jsonify({'error': f'size must be between 1 and {Config.PLANS_MAX_PAGE_SIZE}'}), 400
+
+        query = es_service.search_plans_query(
+            org=request.args.get('org'),
+            plan_type=request.args.get('planType'),
+            min_copay=request.args.get('min_copay', type=float),
+            max_copay=request.args.get('max_copay', type=float),
+            min_deductible=request.args.get('min_deductible', type=float),
+            max_deductible=request.args.get('max_deductible', type=float),
+            service_name=request.args.get('service')
+        )
+        ids_only = request.args.get('ids_only') == 'true'
+        hits, search_after = es_service.search_plans(es, query, size,
+                                                     search_after=request.args.get('search_after'),
+                                                     ids_only=ids_only)
+        if not ids_only:
+            return jsonify({"plans": hits, "search_after": search_after}), 200
+
+        # Hydrate the matching ids with the full plans, passing the stored bytes through
+        body = b'{"plans":[' + b','.join(redis_service.get_raw_plans(hits)) + b'],"search_after":' + \
+            json.dumps(search_after).encode('utf-8') + b'}'
+        return Response(body, status=200, mimetype='application/json')
     except (ConnectionError, TimeoutError) as e:
         return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
 
@@ -101,26 +255,86 @@ def get_all_plans():
 @api_bp.route('/v1/patch/<string:key>', methods=['PATCH'])
 def patch_item(key):
     try:
-        current_plan_data, current_etag = redis_service.get_plan(key)
-        if not current_plan_data:
+        current_etag = redis_service.get_etag(key)
+        if not current_etag:
             return jsonify({"message": "Item not found"}), 404
 
         if current_etag != request.headers.get('If-Match'):
             return jsonify({"message": "ETag does not match"}), 412
 
-        patch_data = request.json
-        new_plan = PatchPlanSchema(**patch_data)
+        new_plan = PatchPlanSchema.model_validate_json(request.get_data())
 
-        req = {"action": "patch", "document": new_plan.dict()}
-        channel.basic_publish(exchange='',
-                              routing_key='medical_plan',
-                              body=json.dumps(req))
+        # The consumer re-checks the ETag when it applies the patch
+        operation_id = uuid4().hex
+        publisher.publish(queue_for(new_plan.objectId),
+                          queue_message("patch", new_plan.model_dump_json().encode('utf-8'),
+                                        etag=current_etag, operation_id=operation_id))
 
-        return jsonify({"message": "request queued for processing"}), 200
+        return _queued(operation_id, "patch", "request queued for processing", 200)
 
     except ValidationError as e:
-        return jsonify(e.errors()), 400
+        return Response(e.json(), status=400, mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/plan/<plan_id>/linkedPlanServices/<service_id>', methods=['GET'])
+def get_plan_service(plan_id, service_id):
+    try:
+        # Services share the ETag of their plan
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and if_none_match == redis_service.get_etag(plan_id):
+            return '', 304
+
+        service_data, etag = redis_service.get_service(plan_id, service_id)
+        if service_data:
+            return Response(service_data, status=200, mimetype='application/json', headers={'ETag': etag})
+        return jsonify({'error': 'Service not found'}), 404
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/plan/<plan_id>/linkedPlanServices/<service_id>', methods=['PATCH'])
+def patch_plan_service(plan_id, service_id):
+    try:
+        current_etag = redis_service.get_etag(plan_id)
+        if not current_etag:
+            return jsonify({"message": "Item not found"}), 404
+
+        if current_etag != request.headers.get('If-Match'):
+            return jsonify({"message": "ETag does not match"}), 412
+
+        service = PatchLinkedPlanServiceItem.model_validate_json(request.get_data())
+        service.objectId = service_id
+
+        operation_id = uuid4().hex
+        publisher.publish(queue_for(plan_id),
+                          queue_message("patch_service", service.model_dump_json().encode('utf-8'),
+                                        plan_id=plan_id, etag=current_etag, operation_id=operation_id))
+
+        return _queued(operation_id, "patch_service", "request queued for processing", 200)
+
+    except ValidationError as e:
+        return Response(e.json(), status=400, mimetype='application/json')
     except ValueError as e:
         return jsonify({'error': str(e)}), 409
     except (ConnectionError, TimeoutError) as e:
         return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
+
+
+@api_bp.route('/v1/operations/<operation_id>', methods=['GET'])
+def get_operation(operation_id):
+    try:
+        # Long-poll with ?wait=N or `Prefer: wait=N`, answered as soon as the consumer reports
+        wait = _wait_seconds()
+        if wait:
+            result = operation_waiter.wait(operation_id, wait)
+        else:
+            result = operation_waiter.result(operation_id)
+        if result is None:
+            return jsonify({"operation_id": operation_id, "status": "pending"}), 202
+        return jsonify(result), 200
+    except (ConnectionError, TimeoutError) as e:
+        return jsonify({'error': 'Service Unavailable', 'details': str(e)}), 503
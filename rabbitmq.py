@@ -1,6 +1,35 @@
+import functools
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
 import pika
+from pika.adapters.select_connection import IOLoop
 
 from config import Config
+from services import metrics
+
+
+def shard_queue_name(shard):
+    """Queue of `shard`, raises ValueError for shards that QUEUE_SHARDS does not have."""
+    if not 0 <= shard < Config.QUEUE_SHARDS:
+        raise ValueError(f"Shard {shard} does not exist, QUEUE_SHARDS is {Config.QUEUE_SHARDS}")
+    if Config.QUEUE_SHARDS == 1:
+        return Config.QUEUE_NAME
+    return f"{Config.QUEUE_NAME}.{shard}"
+
+
+def queue_for(object_id):
+    """Queue for every message about `object_id`, so one consumer applies them in order."""
+    return shard_queue_name(zlib.crc32(object_id.encode('utf-8')) % Config.QUEUE_SHARDS)
+
+
+def queue_message(action, document, **fields):
+    """Message for `action` around `document`, JSON bytes that are embedded as they are."""
+    head = json.dumps({"action": action, **fields})[:-1]
+    return f'{head}, "document": '.encode('utf-8') + document + b'}'
 
 
 class RabbitMQ:
@@ -33,6 +62,51 @@ class RabbitMQ:
         self.channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
         self.channel.start_consuming()
 
+    def consume_batches(self, queue_name, callback, prefetch_count, batch_size, max_wait):
+        """
+        Deliver messages to `callback` as a list of bodies, at most `batch_size` at a
+        time and no later than `max_wait` seconds after the first one arrived.
+
+        Messages are acked only once `callback` returns, so a crash mid-batch leaves
+        them unacked for redelivery. `callback` returns the indexes of the messages it
+        could not apply, those are rejected without requeueing so they cannot block the
+        queue (a dead letter policy on the queue keeps them). `prefetch_count` should be
+        at least `batch_size`.
+        """
+        if not self.channel:
+            raise Exception("Connection is not established.")
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+        batch = []
+        deadline = None
+        next_depth_check = 0
+        for method, properties, body in self.channel.consume(queue=queue_name, inactivity_timeout=max_wait):
+            if method is not None:
+                if not batch:
+                    deadline = time.monotonic() + max_wait
+                batch.append((method.delivery_tag, properties, body))
+
+            if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+                rejected = set(callback([body for _, _, body in batch]) or ())
+                for index in sorted(rejected):
+                    self.channel.basic_nack(delivery_tag=batch[index][0], requeue=False)
+                # A multiple ack settles every earlier delivery that is not rejected already
+                applied = [tag for index, (tag, _, _) in enumerate(batch) if index not in rejected]
+                if applied:
+                    self.channel.basic_ack(delivery_tag=applied[-1], multiple=True)
+                applied_at = time.time()
+                for _, properties, _ in batch:
+                    published_at = (properties.headers or {}).get('published_at')
+                    if published_at:
+                        metrics.QUEUE_LAG_SECONDS.labels(queue_name).observe(applied_at - published_at)
+                batch = []
+
+            if time.monotonic() >= next_depth_check:
+                # A passive declare is a broker round trip, so the depth is sampled
+                depth = self.channel.queue_declare(queue=queue_name, passive=True).method.message_count
+                metrics.QUEUE_DEPTH.labels(queue_name).set(depth)
+                next_depth_check = time.monotonic() + Config.QUEUE_DEPTH_INTERVAL
+
     def publish(self, queue_name, message):
         if not self.channel:
             raise Exception("Connection is not established.")
@@ -42,5 +116,133 @@ class RabbitMQ:
                                    body=message,
                                    properties=pika.BasicProperties(
                                        delivery_mode=2,  # make message persistent
+                                       headers={'published_at': time.time()},
                                    ))
-        print(f"Sent message to queue {queue_name}: {message}")
+
+
+class Publisher:
+    """
+    Thread-safe publisher. A dedicated I/O thread owns the connection and reconnects
+    when it drops; `publish` hands messages to that thread from any request thread
+    and waits for the broker's confirm. RabbitMQ confirms many deliveries with one
+    `multiple` ack, so concurrent publishes share their confirm round trips.
+    """
+
+    def __init__(self, queues, reconnect_delay=1):
+        self._parameters = pika.ConnectionParameters(
+            host=Config.RABBITMQ_HOST, port=Config.RABBITMQ_PORT,
+            credentials=pika.PlainCredentials(Config.RABBITMQ_USER, Config.RABBITMQ_PASSWORD),
+            heartbeat=10
+        )
+        self._queues = queues
+        self._reconnect_delay = reconnect_delay
+        self._ioloop = IOLoop()
+        self._connection = None
+        self._channel = None
+        self._delivery_tag = 0
+        self._pending = {}
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._connection = pika.SelectConnection(self._parameters,
+                                                     on_open_callback=self._on_connection_open,
+                                                     on_open_error_callback=self._on_connection_error,
+                                                     on_close_callback=self._on_connection_closed,
+                                                     custom_ioloop=self._ioloop)
+            self._ioloop.start()
+            time.sleep(self._reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        print(f"Could not connect to RabbitMQ: {error}")
+        self._ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"RabbitMQ connection closed: {reason}")
+        self._on_channel_closed(None, reason)
+        self._ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        # Durable queues and persistent messages, so a confirm means the broker has the message on disk
+        for queue_name in self._queues:
+            channel.queue_declare(queue=queue_name, durable=True)
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.confirm_delivery(self._on_delivery_confirmation, callback=lambda frame: self._ready.set())
+
+    def _on_channel_closed(self, channel, reason):
+        self._ready.clear()
+        self._channel = None
+        for future in self._pending.values():
+            future.set_exception(ConnectionError(f"RabbitMQ channel closed: {reason}"))
+        self._pending = {}
+        if channel is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            future = self._pending.pop(tag, None)
+            if future is None:
+                continue
+            if isinstance(method, pika.spec.Basic.Ack):
+                future.set_result(tag)
+            else:
+                future.set_exception(ConnectionError("Message was rejected by RabbitMQ"))
+
+    def _publish(self, routing_key, body, future):
+        if self._channel is None or not self._channel.is_open:
+            future.set_exception(ConnectionError("RabbitMQ channel is not open"))
+            return
+        # The consumer measures queue lag from this header
+        self._channel.basic_publish(exchange='', routing_key=routing_key, body=body,
+                                    properties=pika.BasicProperties(delivery_mode=2,
+                                                                    headers={'published_at': time.time()}))
+        self._delivery_tag += 1
+        self._pending[self._delivery_tag] = future
+
+    def _publish_many(self, messages, futures):
+        for (routing_key, body), future in zip(messages, futures):
+            self._publish(routing_key, body, future)
+
+    def publish(self, routing_key, body, timeout=5):
+        """
+        Publish `body` to `routing_key` and return once the broker confirmed it.
+
+        Raises ConnectionError if the broker is unreachable or rejected the message
+        and TimeoutError if no confirm arrived within `timeout` seconds.
+        """
+        with metrics.track('publish'):
+            if not self._ready.wait(timeout):
+                raise ConnectionError("RabbitMQ is not connected")
+
+            future = Future()
+            self._ioloop.add_callback_threadsafe(functools.partial(self._publish, routing_key, body, future))
+            future.result(timeout)
+
+    def publish_many(self, messages, timeout=5):
+        """
+        Publish (routing_key, body) pairs in one hand-off to the I/O thread and return
+        once all of them are confirmed, which usually takes a few `multiple` acks.
+        Raises like `publish`, `timeout` applies to the whole batch.
+        """
+        with metrics.track('publish'):
+            deadline = time.monotonic() + timeout
+            if not self._ready.wait(timeout):
+                raise ConnectionError("RabbitMQ is not connected")
+
+            futures = [Future() for _ in messages]
+            self._ioloop.add_callback_threadsafe(functools.partial(self._publish_many, messages, futures))
+            for future in futures:
+                future.result(max(deadline - time.monotonic(), 0))
@@ -0,0 +1,121 @@
+import argparse
+import os
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+import redis
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import BulkIndexError
+
+from config import Config
+from data_models.es_mappings import INDEX_MAPPING, INDEX_NAME
+from services import es_service, normalized_store
+from services.plan_codec import PlanCodec
+
+# Clients of the worker processes, created once per process
+redis_client = None
+es = None
+plan_codec = PlanCodec(Config.PLAN_CODEC)
+
+
+def connect():
+    global redis_client, es
+    redis_client = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+    es = Elasticsearch(
+        [{'host': Config.ES_HOST, 'port': Config.ES_PORT, 'scheme': 'http'}],
+        basic_auth=(Config.ES_USER, Config.ES_PASSWORD),
+        request_timeout=120
+    )
+
+
+def key_batches(batch_size):
+    keys = redis_client.scan_iter(match="plan:*", count=batch_size)
+    while True:
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def load_batch(args):
+    """Flatten one batch of plans into join documents and bulk-load them. Runs in a worker."""
+    keys, index = args
+    operations = []
+    plans = 0
+    values = redis_client.mget(keys)
+    # The objects of every normalized plan of the batch are read together
+    normalized_ids = [key.decode('utf-8').split(':', 1)[1] for key, plan_data in zip(keys, values)
+                      if normalized_store.is_normalized(plan_data)]
+    normalized = dict(zip(normalized_ids, normalized_store.read_many(redis_client, normalized_ids)))
+    for key, plan_data in zip(keys, values):
+        if normalized_store.is_normalized(plan_data):
+            plan_data = normalized[key.decode('utf-8').split(':', 1)[1]]
+        elif plan_data:
+            plan_data = plan_codec.decode(plan_data)
+        if plan_data:
+            operations += es_service.plan_to_operations(plan_data, index=index)
+            plans += 1
+
+    try:
+        es_service.send_bulk(es, operations)
+        return plans, 0
+    except BulkIndexError as e:
+        for item in e.errors:
+            print(f"Failed to index {item}")
+        return plans, len(e.errors)
+
+
+def swap_alias(new_index):
+    """Point INDEX_NAME at `new_index` in one atomic aliases call."""
+    actions = [{"add": {"index": new_index, "alias": INDEX_NAME}}]
+    if es.indices.exists_alias(name=INDEX_NAME):
+        old_indices = list(es.indices.get_alias(name=INDEX_NAME))
+        actions = [{"remove": {"index": old, "alias": INDEX_NAME}} for old in old_indices] + actions
+    elif es.indices.exists(index=INDEX_NAME):
+        # A concrete index from before aliases were used is dropped in the same call
+        old_indices = [INDEX_NAME]
+        actions = [{"remove_index": {"index": INDEX_NAME}}] + actions
+    else:
+        old_indices = []
+    es.indices.update_aliases(actions=actions)
+    return old_indices
+
+
+def reindex(workers, batch_size, replicas):
+    connect()
+    new_index = f"{INDEX_NAME}_{int(time.time())}"
+
+    # Load without replicas or refreshes, both are restored before the swap
+    es.indices.create(index=new_index, mappings=INDEX_MAPPING['mappings'],
+                      settings={"number_of_replicas": 0, "refresh_interval": "-1"})
+    print(f"Loading plans into '{new_index}' with {workers} workers")
+
+    started = time.monotonic()
+    plans = failures = 0
+    with Pool(workers, initializer=connect) as pool:
+        batches = ((keys, new_index) for keys in key_batches(batch_size))
+        for loaded, failed in pool.imap_unordered(load_batch, batches):
+            plans += loaded
+            failures += failed
+    print(f"Loaded {plans} plans in {time.monotonic() - started:.1f}s, {failures} failed documents")
+
+    es.indices.put_settings(index=new_index, settings={"number_of_replicas": replicas, "refresh_interval": None})
+    es.indices.refresh(index=new_index)
+
+    if failures:
+        print(f"Not switching '{INDEX_NAME}' to '{new_index}' because of failed documents")
+        return
+
+    old_indices = swap_alias(new_index)
+    print(f"'{INDEX_NAME}' now points to '{new_index}', previous indices: {old_indices}")
+
+
+if __name__ == '__main__':
+    # Stop the consumers while reindexing, queued messages are applied to the new index afterwards
+    parser = argparse.ArgumentParser(description="Rebuild the plans index from Redis.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--replicas', type=int, default=1)
+    args = parser.parse_args()
+    reindex(args.workers, args.batch_size, args.replicas)
@@ -0,0 +1,91 @@
+import json
+from hashlib import md5
+
+from redis import asyncio as aioredis
+
+from config import Config
+from data_models.medical_plan import PatchPlanSchema
+from services import normalized_store
+from services.plan_codec import PlanCodec
+
+# Connections are opened lazily from this shared pool
+redis_client = aioredis.Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+plan_codec = PlanCodec(Config.PLAN_CODEC)
+
+
+async def _plan_json(object_id, plan_data):
+    if normalized_store.is_normalized(plan_data):
+        plan = await normalized_store.async_read(redis_client, object_id)
+        return json.dumps(plan).encode('utf-8') if plan else None
+    return plan_codec.to_json(plan_data)
+
+
+async def _plans_json(keys):
+    """`redis_service._plans_json` for the asyncio client."""
+    values = await redis_client.mget(keys)
+    normalized_ids = [key.decode('utf-8').split(':', 1)[1] for key, plan_data in zip(keys, values)
+                      if plan_data and normalized_store.is_normalized(plan_data)]
+    normalized = dict(zip(normalized_ids, await normalized_store.async_read_many(redis_client, normalized_ids)))
+
+    plans = []
+    for key, plan_data in zip(keys, values):
+        if plan_data and normalized_store.is_normalized(plan_data):
+            plan = normalized[key.decode('utf-8').split(':', 1)[1]]
+            plan_data = json.dumps(plan).encode('utf-8') if plan else None
+        elif plan_data:
+            plan_data = plan_codec.to_json(plan_data)
+        if plan_data:
+            plans.append(plan_data)
+    return plans
+
+
+async def get_raw_plan(object_id: str):
+    plan_data, etag = await redis_client.mget(f"plan:{object_id}", f"etag:{object_id}")
+    if plan_data:
+        etag = etag.decode('utf-8') if etag else md5(plan_data).hexdigest()
+        plan_data = await _plan_json(object_id, plan_data)
+        if plan_data:
+            return plan_data, etag
+    return None, None
+
+
+async def get_plan(object_id: str):
+    plan_data, etag = await get_raw_plan(object_id)
+    if plan_data:
+        return PatchPlanSchema.parse_raw(plan_data), etag
+    return None, None
+
+
+async def get_etag(object_id: str):
+    etag = await redis_client.get(f"etag:{object_id}")
+    if etag:
+        return etag.decode('utf-8')
+    plan_data = await redis_client.get(f"plan:{object_id}")
+    return md5(plan_data).hexdigest() if plan_data else None
+
+
+async def scan_plan_keys(cursor: int, limit: int):
+    keys = []
+    while True:
+        cursor, batch = await redis_client.scan(cursor=cursor, match="plan:*", count=limit - len(keys))
+        keys.extend(batch)
+        if cursor == 0 or len(keys) >= limit:
+            return keys, cursor
+
+
+async def get_all_plans(cursor: int, limit: int):
+    keys, next_cursor = await scan_plan_keys(cursor, limit)
+    plans = []
+    if keys:
+        plans = [PatchPlanSchema.parse_raw(plan_data) for plan_data in await _plans_json(keys)]
+    return plans, next_cursor
+
+
+async def iter_raw_plans(batch_size: int, cursor: int = 0):
+    while True:
+        keys, cursor = await scan_plan_keys(cursor, batch_size)
+        if keys:
+            for plan_data in await _plans_json(keys):
+                yield plan_data
+        if cursor == 0:
+            return
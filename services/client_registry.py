@@ -0,0 +1,52 @@
+import os
+import threading
+
+
+class ClientRegistry:
+    """
+    Clients built lazily, once per process, from factories the app factory registers.
+
+    Nothing connects at import or in `create_app`, and a forked worker builds its
+    own clients on first use instead of inheriting the parent's sockets and threads.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+        self._clients.pop(name, None)
+
+    def get(self, name):
+        if self._pid != os.getpid():
+            # Forked, everything inherited from the parent belongs to the parent
+            self._clients = {}
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    if name not in self._factories:
+                        raise RuntimeError(f"No client '{name}' registered, create the app first")
+                    client = self._clients[name] = self._factories[name]()
+        return client
+
+    def proxy(self, name):
+        return ClientProxy(self, name)
+
+
+class ClientProxy:
+    """Module-level stand-in for a registered client, resolved on every attribute access."""
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
@@ -0,0 +1,251 @@
+from datetime import datetime
+
+from elasticsearch.helpers import BulkIndexError
+
+from data_models.es_mappings import INDEX_NAME
+from services import metrics
+
+
+def _index_op(doc_id, routing, source, index=INDEX_NAME):
+    action = {"_index": index, "_id": doc_id}
+    if routing:
+        action["routing"] = routing
+    return [{"index": action}, source]
+
+
+def update_operation(doc_id, routing, doc, index=INDEX_NAME):
+    action = {"_index": index, "_id": doc_id}
+    if routing:
+        action["routing"] = routing
+    return [{"update": action}, {"doc": doc}]
+
+
+def plan_documents(document):
+    """
+    Flatten a plan into its parent/child join documents as {id: (routing, source)}.
+
+    Every document of a join lives on the shard of the root plan, so grandchildren
+    (linkedService, planserviceCostShares) are routed by the plan id as well.
+    """
+    parent_id = document['objectId']
+    documents = {parent_id: (None, {
+        "objectId": parent_id,
+        "org": document['org'],
+        "objectType": document['objectType'],
+        "planType": document['planType'],
+        "join_field": {
+            "name": "plan"
+        }
+    })}
+
+    cost_shares = document.get('planCostShares')
+    if cost_shares:
+        documents[cost_shares['objectId']] = (parent_id, {
+            "objectId": cost_shares['objectId'],
+            "deductible": cost_shares['deductible'],
+            "copay": cost_shares['copay'],
+            "org": cost_shares['org'],
+            "objectType": cost_shares['objectType'],
+            "join_field": {
+                "name": "planCostShares",
+                "parent": parent_id
+            }
+        })
+
+    for service in document.get('linkedPlanServices') or []:
+        documents.update(service_documents(service, parent_id))
+
+    return documents
+
+
+def service_documents(service, parent_id):
+    service_id = service['objectId']
+    documents = {service_id: (parent_id, {
+        "objectId": service_id,
+        "org": service['org'],
+        "objectType": service['objectType'],
+        "join_field": {
+            "name": "linkedPlanServices",
+            "parent": parent_id
+        }
+    })}
+
+    linked_service = service.get('linkedService')
+    if linked_service:
+        documents[linked_service['objectId']] = (parent_id, {
+            "objectId": linked_service['objectId'],
+            "name": linked_service['name'],
+            "org": linked_service['org'],
+            "objectType": linked_service['objectType'],
+            "join_field": {
+                "name": "linkedService",
+                "parent": service_id
+            }
+        })
+
+    cost_shares = service.get('planserviceCostShares')
+    if cost_shares:
+        documents[cost_shares['objectId']] = (parent_id, {
+            "objectId": cost_shares['objectId'],
+            "deductible": cost_shares['deductible'],
+            "copay": cost_shares['copay'],
+            "org": cost_shares['org'],
+            "objectType": cost_shares['objectType'],
+            "join_field": {
+                "name": "planserviceCostShares",
+                "parent": service_id
+            }
+        })
+
+    return documents
+
+
+def plan_to_operations(document, index=INDEX_NAME):
+    """Flatten a plan into `_bulk` index operations for its join documents."""
+    operations = []
+    for doc_id, (routing, source) in plan_documents(document).items():
+        if routing is None:
+            source = {**source, "creationDate": document.get('creationDate') or datetime.utcnow()}
+        operations += _index_op(doc_id, routing, source, index)
+    return operations
+
+
+def diff_operations(old_document, new_document, index=INDEX_NAME):
+    """
+    Minimal `_bulk` operations turning the join documents of `old_document` into
+    those of `new_document`: new documents are indexed, changed ones get a partial
+    update of the changed fields and documents that disappeared are deleted.
+    """
+    return _diff(plan_documents(old_document), plan_documents(new_document), index)
+
+
+def service_diff_operations(old_service, new_service, parent_id, index=INDEX_NAME):
+    """`diff_operations` for a single linkedPlanServices item of plan `parent_id`."""
+    return _diff(service_documents(old_service, parent_id), service_documents(new_service, parent_id), index)
+
+
+def _diff(old_documents, new_documents, index):
+    operations = []
+    for doc_id, (routing, source) in new_documents.items():
+        if doc_id not in old_documents:
+            operations += _index_op(doc_id, routing, source, index)
+            continue
+        old_source = old_documents[doc_id][1]
+        changed = {field: value for field, value in source.items() if old_source.get(field) != value}
+        if changed:
+            operations += update_operation(doc_id, routing, changed, index)
+
+    for doc_id, (routing, _) in old_documents.items():
+        if doc_id not in new_documents:
+            action = {"_index": index, "_id": doc_id}
+            if routing:
+                action["routing"] = routing
+            operations.append({"delete": action})
+
+    return operations
+
+
+def send_bulk(es, operations):
+    """
+    Send `operations` as a single `_bulk` request.
+
+    Raises BulkIndexError carrying the failed items if any of them were rejected.
+    """
+    if not operations:
+        return None
+
+    with metrics.track('es'):
+        response = es.bulk(operations=operations)
+    metrics.ES_BULK_DOCUMENTS.observe(len(response['items']))
+    if response.get('errors'):
+        failed = [item for item in response['items'] if next(iter(item.values())).get('error')]
+        raise BulkIndexError(f"{len(failed)} document(s) failed in bulk request.", failed)
+    return response
+
+
+def search_plans_query(org=None, plan_type=None, min_copay=None, max_copay=None,
+                       min_deductible=None, max_deductible=None, service_name=None):
+    """Query for plan (parent) documents, child attributes are matched through has_child."""
+    filters = [{"term": {"join_field": "plan"}}]
+    if org:
+        filters.append({"term": {"org": org}})
+    if plan_type:
+        filters.append({"term": {"planType": plan_type}})
+
+    cost_ranges = {}
+    if min_copay is not None or max_copay is not None:
+        cost_ranges["copay"] = {"gte": min_copay, "lte": max_copay}
+    if min_deductible is not None or max_deductible is not None:
+        cost_ranges["deductible"] = {"gte": min_deductible, "lte": max_deductible}
+    if cost_ranges:
+        filters.append({"has_child": {"type": "planCostShares", "query": {"bool": {"filter": [
+            {"range": {field: {key: value for key, value in bounds.items() if value is not None}}}
+            for field, bounds in cost_ranges.items()
+        ]}}}})
+
+    if service_name:
+        filters.append({"has_child": {"type": "linkedPlanServices", "query": {
+            "has_child": {"type": "linkedService", "query": {"match": {"name": service_name}}}
+        }}})
+
+    return {"bool": {"filter": filters}}
+
+
+def search_plans(es, query, size, search_after=None, ids_only=False, index=INDEX_NAME):
+    """
+    One page of plans matching `query`, ordered by objectId.
+
+    Returns the hits (ids when `ids_only`) and the objectId to pass as
+    `search_after` for the next page, None on the last page.
+    """
+    with metrics.track('es'):
+        response = es.search(index=index, query=query, size=size, sort=[{"objectId": "asc"}],
+                             search_after=[search_after] if search_after else None,
+                             source=not ids_only)
+    hits = response['hits']['hits']
+    next_search_after = hits[-1]['sort'][0] if len(hits) == size else None
+    if ids_only:
+        return [hit['_id'] for hit in hits], next_search_after
+    return [hit['_source'] for hit in hits], next_search_after
+
+
+def plan_child_ids(document):
+    """Ids of every join descendant of a plan, taken from its stored document."""
+    child_ids = []
+    if document.get('planCostShares'):
+        child_ids.append(document['planCostShares']['objectId'])
+    for service in document.get('linkedPlanServices', []):
+        child_ids.append(service['objectId'])
+        for key in ('linkedService', 'planserviceCostShares'):
+            if service.get(key):
+                child_ids.append(service[key]['objectId'])
+    return child_ids
+
+
+def search_child_ids(es, plan_id, page_size=1000, index=INDEX_NAME):
+    """Ids of every join descendant of a plan, paginated with search_after."""
+    is_child = {"has_parent": {"parent_type": "plan", "query": {"term": {"objectId": plan_id}}}}
+    query = {
+        "bool": {
+            "should": [
+                is_child,
+                {"has_parent": {"parent_type": "linkedPlanServices", "query": is_child}}
+            ]
+        }
+    }
+
+    child_ids = []
+    search_after = None
+    while True:
+        with metrics.track('es'):
+            response = es.search(index=index, query=query, routing=plan_id, size=page_size,
+                                 sort=[{"objectId": "asc"}], source=False, search_after=search_after)
+        hits = response['hits']['hits']
+        child_ids.extend(hit['_id'] for hit in hits)
+        if len(hits) < page_size:
+            return child_ids
+        search_after = hits[-1]['sort']
+
+
+def delete_operations(doc_ids, routing, index=INDEX_NAME):
+    return [{"delete": {"_index": index, "_id": doc_id, "routing": routing}} for doc_id in doc_ids]
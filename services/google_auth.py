@@ -1,25 +1,79 @@
+import re
+import threading
+import time
+from hashlib import sha256
+
+from cachetools import TTLCache
 from flask import request, jsonify
 
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 from google.auth.exceptions import InvalidValue
 
+MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+
+class CachedCertsRequest:
+    """
+    Transport that keeps GET responses, i.e. Google's signing certs, for as long
+    as their Cache-Control max-age allows instead of refetching them per token.
+    """
+
+    def __init__(self):
+        self._request = google_requests.Request()
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method='GET', **kwargs):
+        if method != 'GET':
+            return self._request(url, method=method, **kwargs)
+
+        cached = self._responses.get(url)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        response = self._request(url, method=method, **kwargs)
+        max_age = MAX_AGE_PATTERN.search(response.headers.get('cache-control', ''))
+        if response.status == 200 and max_age:
+            with self._lock:
+                self._responses[url] = (response, time.monotonic() + int(max_age.group(1)))
+        return response
+
 
 class GoogleAuth:
-    def __init__(self, client_id):
+    def __init__(self, client_id, token_cache_size=10000, token_cache_ttl=300):
         self.client_id = client_id
+        self._request = CachedCertsRequest()
+        # Verified tokens keyed by their hash, never kept past the token's own expiry
+        self._verified_tokens = TTLCache(maxsize=token_cache_size, ttl=token_cache_ttl)
+        self._lock = threading.Lock()
+
+    def cached_token(self, token):
+        """Decoded `token` if it was verified before and has not expired, without any I/O."""
+        with self._lock:
+            decoded_token = self._verified_tokens.get(sha256(token.encode('utf-8')).digest())
+        if decoded_token and decoded_token['exp'] > time.time():
+            return decoded_token
+        return None
 
     def verify_token(self, token):
+        decoded_token = self.cached_token(token)
+        if decoded_token:
+            return decoded_token
+
         try:
             # Verify the token and get the decoded token
             decoded_token = id_token.verify_oauth2_token(
                 token,
-                google_requests.Request(),
+                self._request,
                 self.client_id
             )
-            return decoded_token
         except InvalidValue as e:
             return None
         except ValueError:
             # Token is invalid
             return None
+
+        with self._lock:
+            self._verified_tokens[sha256(token.encode('utf-8')).digest()] = decoded_token
+        return decoded_token
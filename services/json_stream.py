@@ -0,0 +1,60 @@
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+# Escapes, quotes, braces and runs of anything else that is not JSON punctuation
+TOKENS = re.compile(rb'\\.|["{}]|[^\s,\[\]{}"\\]+', re.S)
+
+
+def iter_ndjson(stream):
+    """(line number, raw bytes) of every non-empty line of `stream`, blank lines are counted too."""
+    for line_number, line in enumerate(iter(stream.readline, b''), start=1):
+        line = line.strip()
+        if line:
+            yield line_number, line
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """
+    Raw bytes of every element of a top-level JSON array, reading `stream` one
+    chunk at a time. Objects are cut out by brace depth without being parsed,
+    anything else at the top level is yielded as is so it fails validation.
+    """
+    buffer = b''
+    start = pos = depth = 0
+    in_string = False
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+
+        # Scanning resumes after the last token, so tokens cut by the chunk end are read again whole
+        for match in TOKENS.finditer(buffer, pos):
+            token = match.group()
+            pos = match.end()
+            if in_string:
+                in_string = token != b'"'
+            elif token == b'{':
+                if depth == 0:
+                    start = match.start()
+                depth += 1
+            elif token == b'}' and depth:
+                depth -= 1
+                if depth == 0:
+                    yield buffer[start:pos]
+            elif token == b'"':
+                in_string = True
+                if depth == 0:
+                    yield token
+            elif depth == 0:
+                yield token
+
+        # Keep only the object being read
+        cut = start if depth else pos
+        buffer = buffer[cut:]
+        start -= cut
+        pos -= cut
+
+    if depth:
+        yield buffer[start:]
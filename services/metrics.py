@@ -0,0 +1,96 @@
+"""
+Prometheus metrics of the API and the consumer.
+
+Every API request and consumer command runs in a scope (`start`/`finish`).
+Time spent in auth, Redis, Elasticsearch or publishing is added up per
+scope with `track`, and recorded as one observation per stage when the scope ends.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+from redis.connection import Connection
+
+REQUEST_SECONDS = Histogram('medical_plan_request_seconds', 'API request latency',
+                            ['route', 'method', 'status'])
+REQUEST_STAGE_SECONDS = Histogram('medical_plan_request_stage_seconds',
+                                  'Time of an API request spent in auth, Redis, Elasticsearch or publishing',
+                                  ['route', 'stage'])
+COMMAND_SECONDS = Histogram('medical_plan_command_seconds', 'Execution time of consumer commands and batch flushes',
+                            ['command'])
+COMMAND_STAGE_SECONDS = Histogram('medical_plan_command_stage_seconds',
+                                  'Time of a consumer command spent in Elasticsearch or Redis',
+                                  ['command', 'stage'])
+ES_BULK_DOCUMENTS = Histogram('medical_plan_es_bulk_documents', 'Documents per Elasticsearch bulk request',
+                              buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+REDIS_ROUND_TRIPS = Counter('medical_plan_redis_round_trips_total', 'Redis round trips per route or command',
+                            ['scope'])
+COALESCED_MESSAGES = Counter('medical_plan_coalesced_messages_total',
+                             'Consumer messages superseded by a later create or delete of the same plan in a batch')
+QUEUE_DEPTH = Gauge('medical_plan_queue_depth', 'Messages ready in a queue', ['queue'])
+QUEUE_LAG_SECONDS = Histogram('medical_plan_queue_lag_seconds', 'Time from publishing a message to applying it',
+                              ['queue'], buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+
+_local = threading.local()
+
+
+def start(scope):
+    _local.scope = scope
+    _local.stages = {}
+    _local.started = time.perf_counter()
+
+
+def finish():
+    """End the current scope, returns its name, duration and time per stage."""
+    scope, stages = getattr(_local, 'scope', None), getattr(_local, 'stages', None)
+    if scope is None:
+        return None, 0, {}
+    _local.scope = _local.stages = None
+    return scope, time.perf_counter() - _local.started, stages
+
+
+def observe_request(method, status):
+    route, elapsed, stages = finish()
+    if route is None:
+        return
+    REQUEST_SECONDS.labels(route, method, status).observe(elapsed)
+    for stage, seconds in stages.items():
+        REQUEST_STAGE_SECONDS.labels(route, stage).observe(seconds)
+
+
+def observe_command():
+    command, elapsed, stages = finish()
+    if command is None:
+        return
+    COMMAND_SECONDS.labels(command).observe(elapsed)
+    for stage, seconds in stages.items():
+        COMMAND_STAGE_SECONDS.labels(command, stage).observe(seconds)
+
+
+@contextmanager
+def track(stage):
+    """Add the time spent in the block to `stage` of the current scope, if any."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = getattr(_local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + time.perf_counter() - started
+
+
+class InstrumentedConnection(Connection):
+    """
+    Redis connection that counts every round trip and tracks its time as 'redis'.
+    A pipeline is sent in one go, so it counts once however many commands it holds.
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        REDIS_ROUND_TRIPS.labels(getattr(_local, 'scope', None) or 'other').inc()
+        with track('redis'):
+            super().send_packed_command(command, check_health)
+
+    def read_response(self, *args, **kwargs):
+        with track('redis'):
+            return super().read_response(*args, **kwargs)
@@ -0,0 +1,146 @@
+import json
+
+from services.plan_codec import NORMALIZED
+
+# Stored under plan:{id} for plans in the normalized layout, so plans are still
+# found by scanning plan:* while their objects live in one hash each.
+MARKER = bytes([NORMALIZED])
+
+
+def object_key(object_id):
+    return f"object:{object_id}"
+
+
+def is_normalized(plan_data):
+    return plan_data == MARKER
+
+
+def flatten(document, parent_id=None):
+    """
+    Split `document` into one hash per object with an objectId as {objectId: fields}.
+
+    Field values are JSON encoded so their types survive, nested objects are
+    replaced by their ids in `_children` and every object records its `_parent`.
+    """
+    objects = {}
+
+    def visit(obj, parent):
+        fields = {}
+        children = {}
+        for key, value in obj.items():
+            if isinstance(value, dict) and 'objectId' in value:
+                children[key] = value['objectId']
+                visit(value, obj['objectId'])
+            elif isinstance(value, list) and value and isinstance(value[0], dict):
+                children[key] = [item['objectId'] for item in value]
+                for item in value:
+                    visit(item, obj['objectId'])
+            else:
+                fields[key] = json.dumps(value)
+        fields['_children'] = json.dumps(children)
+        fields['_parent'] = json.dumps(parent)
+        objects[obj['objectId']] = fields
+
+    visit(document, parent_id)
+    return objects
+
+
+def write(pipeline, document, parent_id=None):
+    """Stage the hashes of `document` and all of its descendants."""
+    for object_id, fields in flatten(document, parent_id).items():
+        pipeline.delete(object_key(object_id))
+        pipeline.hset(object_key(object_id), mapping=fields)
+
+
+def write_diff(pipeline, current, merged, parent_id=None):
+    """Stage only the hash fields that differ between `current` and `merged`."""
+    old_objects = flatten(current, parent_id)
+    new_objects = flatten(merged, parent_id)
+    for object_id, fields in new_objects.items():
+        old_fields = old_objects.get(object_id, {})
+        changed = {key: value for key, value in fields.items() if old_fields.get(key) != value}
+        if changed:
+            pipeline.hset(object_key(object_id), mapping=changed)
+    for object_id in old_objects.keys() - new_objects.keys():
+        pipeline.delete(object_key(object_id))
+
+
+def _decode(fields):
+    return {key.decode('utf-8'): json.loads(value) for key, value in fields.items()}
+
+
+def _assemble(objects, object_id):
+    fields = dict(objects[object_id])
+    children = fields.pop('_children')
+    fields.pop('_parent')
+    for key, child in children.items():
+        if isinstance(child, list):
+            fields[key] = [_assemble(objects, item) for item in child if item in objects]
+        else:
+            fields[key] = _assemble(objects, child) if child in objects else None
+    return fields
+
+
+def _children(fields):
+    for child in fields['_children'].values():
+        yield from child if isinstance(child, list) else [child]
+
+
+def _fetch(client, level):
+    """Pipeline of the HGETALLs of one level, the only part that differs between sync and async reads."""
+    pipeline = client.pipeline(transaction=False)
+    for level_id in level:
+        pipeline.hgetall(object_key(level_id))
+    return pipeline
+
+
+def _add_level(objects, level, results):
+    """Record the hashes fetched for `level` in `objects` and return the ids of the next level."""
+    next_level = []
+    for level_id, fields in zip(level, results):
+        if fields:
+            objects[level_id] = _decode(fields)
+            next_level.extend(_children(objects[level_id]))
+    return next_level
+
+
+def _result(objects, object_id, parent_id):
+    if object_id not in objects:
+        return None
+    if parent_id is not None and objects[object_id]['_parent'] != parent_id:
+        return None
+    return _assemble(objects, object_id)
+
+
+def read_many(client, object_ids, parent_id=None):
+    """
+    Assemble objects and their descendants with one pipelined round trip per level
+    for all of them, so a page of plans costs as many round trips as a single plan.
+
+    Returns a list in the order of `object_ids`, with None for objects that do not
+    exist or whose parent is not `parent_id`.
+    """
+    objects = {}
+    level = list(object_ids)
+    while level:
+        level = _add_level(objects, level, _fetch(client, level).execute())
+    return [_result(objects, object_id, parent_id) for object_id in object_ids]
+
+
+def read(client, object_id, parent_id=None):
+    """`read_many` of a single object, None if it does not exist or `parent_id` is not its parent."""
+    return read_many(client, [object_id], parent_id)[0]
+
+
+async def async_read_many(client, object_ids, parent_id=None):
+    """`read_many` for a redis.asyncio client."""
+    objects = {}
+    level = list(object_ids)
+    while level:
+        level = _add_level(objects, level, await _fetch(client, level).execute())
+    return [_result(objects, object_id, parent_id) for object_id in object_ids]
+
+
+async def async_read(client, object_id, parent_id=None):
+    """`read` for a redis.asyncio client."""
+    return (await async_read_many(client, [object_id], parent_id))[0]
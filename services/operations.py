@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+
+PREFER_WAIT = re.compile(r'\bwait=(\d+)')
+
+
+def operation_key(operation_id):
+    return f"operation:{operation_id}"
+
+
+def applied_key(operation_id):
+    """Marker set in the same atomic write that applies an operation's patch to Redis."""
+    return f"operation:{operation_id}:applied"
+
+
+def requested_wait(prefer, wait, max_wait):
+    """Seconds a client is willing to wait, from its `Prefer: wait=N` header (RFC 7240) or `?wait=N`."""
+    match = PREFER_WAIT.search(prefer or '')
+    seconds = match.group(1) if match else wait or '0'
+    return min(int(seconds), max_wait) if seconds.isdigit() else 0
+
+
+def operation_ids(message):
+    """Operations a queue message completes, several once the consumer coalesced it."""
+    if message.get('operation_ids'):
+        return message['operation_ids']
+    return [message['operation_id']] if message.get('operation_id') else []
+
+
+class OperationWaiter:
+    """
+    Lets request threads block until the consumer reports an operation's result.
+
+    The consumer stores results under operation:{id} and publishes their ids to
+    `channel`; one subscriber thread per process wakes the waiting requests.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._redis_client = None
+        self._pid = None
+
+    def start(self, redis_client):
+        """Subscribe through `redis_client` from the first wait of each process."""
+        self._redis_client = redis_client
+
+    def _ensure_listening(self):
+        # Threads do not survive a fork, so every worker starts its own subscriber
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._waiters = {}
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._wake(message['data'].decode('utf-8'))
+            except Exception as e:
+                print(f"Operation completion subscription lost: {e}")
+            # Completions may have been missed, let every waiter re-check Redis
+            with self._lock:
+                operation_ids = list(self._waiters)
+            for operation_id in operation_ids:
+                self._wake(operation_id)
+            time.sleep(1)
+
+    def _wake(self, operation_id):
+        with self._lock:
+            events = list(self._waiters.get(operation_id, ()))
+        for event in events:
+            event.set()
+
+    def result(self, operation_id):
+        """The stored result of an operation, None while it is pending or after it expired."""
+        data = self._redis_client.get(operation_key(operation_id))
+        return json.loads(data) if data else None
+
+    def wait(self, operation_id, timeout):
+        """Result of the operation, waiting up to `timeout` seconds for it. None if it did not complete."""
+        self._ensure_listening()
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(operation_id, []).append(event)
+        try:
+            # Checked after registering, so a completion published in between still wakes us
+            result = self.result(operation_id)
+            if result is None:
+                event.wait(timeout)
+                result = self.result(operation_id)
+            return result
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(operation_id, [])
+                if event in waiters:
+                    waiters.remove(event)
+                if not waiters:
+                    self._waiters.pop(operation_id, None)
+
+
+class AsyncOperationWaiter:
+    """
+    `OperationWaiter` for asyncio servers. One subscriber task on the event loop
+    wakes the requests waiting on an operation.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._waiters = {}
+        self._redis_client = None
+        self._task = None
+
+    def start(self, redis_client):
+        """Subscribe through `redis_client` (a redis.asyncio client) from the first wait."""
+        self._redis_client = redis_client
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _ensure_listening(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self._redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        self._wake(message['data'].decode('utf-8'))
+            except Exception as e:
+                print(f"Operation completion subscription lost: {e}")
+            # Completions may have been missed, let every waiter re-check Redis
+            for operation_id in list(self._waiters):
+                self._wake(operation_id)
+            await asyncio.sleep(1)
+
+    def _wake(self, operation_id):
+        for event in self._waiters.get(operation_id, ()):
+            event.set()
+
+    async def result(self, operation_id):
+        """The stored result of an operation, None while it is pending or after it expired."""
+        data = await self._redis_client.get(operation_key(operation_id))
+        return json.loads(data) if data else None
+
+    async def wait(self, operation_id, timeout):
+        """Result of the operation, waiting up to `timeout` seconds for it. None if it did not complete."""
+        self._ensure_listening()
+        event = asyncio.Event()
+        self._waiters.setdefault(operation_id, []).append(event)
+        try:
+            # Checked after registering, so a completion published in between still wakes us
+            result = await self.result(operation_id)
+            if result is None:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                result = await self.result(operation_id)
+            return result
+        finally:
+            waiters = self._waiters.get(operation_id, [])
+            if event in waiters:
+                waiters.remove(event)
+            if not waiters:
+                self._waiters.pop(operation_id, None)
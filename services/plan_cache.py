@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class PlanCache:
+    """
+    Bounded in-process LRU of raw plan bytes and ETags.
+
+    The consumer publishes the id of every plan it writes or deletes to
+    `channel`; a subscriber thread evicts those ids. While the subscription is
+    down the cache is cleared and bypassed, since invalidations may be missed.
+    """
+
+    def __init__(self, max_bytes, channel):
+        self.max_bytes = max_bytes
+        self.channel = channel
+        self._entries = OrderedDict()
+        self._size = 0
+        self._version = 0
+        self._subscribed = False
+        self._lock = threading.Lock()
+        self._redis_client = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self, redis_client):
+        """Subscribe through `redis_client` from the first cache lookup of each process."""
+        self._redis_client = redis_client
+
+    def _ensure_listening(self):
+        # Threads do not survive a fork, so every worker starts its own subscriber
+        if self._pid == os.getpid() or self._redis_client is None or self.max_bytes <= 0:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._entries.clear()
+            self._size = 0
+            self._subscribed = False
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, args=(self._redis_client,), daemon=True).start()
+
+    def _listen(self, redis_client):
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._subscribed = True
+                for message in pubsub.listen():
+                    self.invalidate(message['data'].decode('utf-8'))
+            except Exception as e:
+                print(f"Plan cache invalidation subscription lost: {e}")
+            self._subscribed = False
+            self.clear()
+            time.sleep(1)
+
+    def version(self):
+        """Take before reading Redis and hand to `put`, so a racing invalidation wins."""
+        return self._version
+
+    def get(self, object_id):
+        self._ensure_listening()
+        if not self._subscribed:
+            return None
+        with self._lock:
+            entry = self._entries.get(object_id)
+            if entry:
+                self._entries.move_to_end(object_id)
+            return entry
+
+    def put(self, object_id, plan_data, etag, version):
+        size = len(plan_data) + len(etag)
+        if not self._subscribed or size > self.max_bytes:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._discard(object_id)
+            self._entries[object_id] = (plan_data, etag)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, object_id):
+        with self._lock:
+            self._version += 1
+            self._discard(object_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, object_id):
+        entry = self._entries.pop(object_id, None)
+        if entry:
+            self._size -= len(entry[0]) + len(entry[1])
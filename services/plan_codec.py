@@ -0,0 +1,53 @@
+import json
+import zlib
+
+import msgpack
+
+# The first byte of a stored plan tells its format. Plans stored before the codec
+# existed are plain JSON text and always start with '{'.
+JSON = ord('{')
+MSGPACK = 1
+MSGPACK_ZLIB = 2
+# Plans in the normalized layout, see services/normalized_store.py
+NORMALIZED = 3
+
+CODECS = {'json': JSON, 'msgpack': MSGPACK, 'msgpack+zlib': MSGPACK_ZLIB}
+
+
+class PlanCodec:
+    """Encodes plans for Redis in the configured format and decodes any known format."""
+
+    def __init__(self, name='json', compression_level=6):
+        if name not in CODECS:
+            raise ValueError(f"Unknown plan codec '{name}', expected one of {list(CODECS)}")
+        self.name = name
+        self.format = CODECS[name]
+        self.compression_level = compression_level
+
+    @property
+    def compressed(self):
+        return self.format == MSGPACK_ZLIB
+
+    def encode(self, plan):
+        if self.format == JSON:
+            return json.dumps(plan).encode('utf-8')
+        packed = msgpack.packb(plan)
+        if self.format == MSGPACK_ZLIB:
+            return bytes([MSGPACK_ZLIB]) + zlib.compress(packed, self.compression_level)
+        return bytes([MSGPACK]) + packed
+
+    def decode(self, value):
+        fmt = value[0]
+        if fmt == MSGPACK:
+            return msgpack.unpackb(value[1:])
+        if fmt == MSGPACK_ZLIB:
+            return msgpack.unpackb(zlib.decompress(value[1:]))
+        if fmt == NORMALIZED:
+            raise ValueError("Normalized plans are read through services.normalized_store")
+        return json.loads(value)
+
+    def to_json(self, value):
+        """JSON bytes of a stored plan, JSON values are passed through untouched."""
+        if value[0] == JSON:
+            return value
+        return json.dumps(self.decode(value)).encode('utf-8')
@@ -0,0 +1,146 @@
+MERGE_PLAN_SCRIPT = """
+-- Atomically merge a patch into a stored plan.
+-- KEYS[1] plan key, KEYS[2] ETag key, KEYS[3] (optional) applied marker of the patch's operation
+-- ARGV[1] patch JSON, ARGV[2] expected ETag ('' skips the check),
+-- ARGV[3] invalidation channel, ARGV[4] plan id, ARGV[5] format to store ('json' or 'msgpack'),
+-- ARGV[6] seconds to keep the applied marker
+-- Returns {'applied', etag} for a redelivered patch that was merged before, {'missing'},
+-- {'conflict', etag}, {'unsupported'} for plans stored in a format Lua cannot read
+-- (compressed or normalized) or without the Lua libraries the merge needs,
+-- or {'ok', etag, old plan, merged plan}
+if KEYS[3] then
+    local applied = redis.call('GET', KEYS[3])
+    if applied then
+        return {'applied', applied}
+    end
+end
+
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return {'missing'}
+end
+
+-- Plans written before ETags were stored have none to compare against
+local etag = redis.call('GET', KEYS[2])
+if ARGV[2] ~= '' and etag and etag ~= ARGV[2] then
+    return {'conflict', etag}
+end
+
+-- See services/plan_codec.py for the format byte
+local plan
+local format = string.byte(current, 1)
+
+-- Lua environments without redis.sha1hex or cmsgpack (fakeredis) merge in the caller's transaction
+if not redis.sha1hex or (not cmsgpack and (format == 1 or ARGV[5] == 'msgpack')) then
+    return {'unsupported'}
+end
+
+if format == 1 then
+    plan = cmsgpack.unpack(string.sub(current, 2))
+elseif format == 123 then
+    plan = cjson.decode(current)
+else
+    return {'unsupported'}
+end
+local patch = cjson.decode(ARGV[1])
+
+local function merge(target, source)
+    for key, value in pairs(source) do
+        if value ~= cjson.null then
+            target[key] = value
+        end
+    end
+end
+
+if type(patch.planCostShares) == 'table' then
+    if type(plan.planCostShares) == 'table' then
+        merge(plan.planCostShares, patch.planCostShares)
+    else
+        plan.planCostShares = patch.planCostShares
+    end
+end
+
+if type(patch.linkedPlanServices) == 'table' then
+    if type(plan.linkedPlanServices) ~= 'table' then
+        plan.linkedPlanServices = {}
+    end
+    local existing = {}
+    for _, service in ipairs(plan.linkedPlanServices) do
+        existing[service.objectId] = service
+    end
+    for _, item in ipairs(patch.linkedPlanServices) do
+        local service = existing[item.objectId]
+        if service then
+            for key, value in pairs(item) do
+                if (key == 'linkedService' or key == 'planserviceCostShares')
+                        and type(value) == 'table' and type(service[key]) == 'table' then
+                    merge(service[key], value)
+                elseif value ~= cjson.null then
+                    service[key] = value
+                end
+            end
+        else
+            table.insert(plan.linkedPlanServices, item)
+        end
+    end
+end
+
+for _, field in ipairs({'objectType', 'planType', 'org', 'creationDate'}) do
+    local value = patch[field]
+    if value ~= nil and value ~= cjson.null and value ~= '' then
+        plan[field] = value
+    end
+end
+
+local merged
+if ARGV[5] == 'msgpack' then
+    merged = string.char(1) .. cmsgpack.pack(plan)
+else
+    merged = cjson.encode(plan)
+end
+local new_etag = redis.sha1hex(merged)
+redis.call('SET', KEYS[1], merged)
+redis.call('SET', KEYS[2], new_etag)
+if KEYS[3] then
+    redis.call('SET', KEYS[3], new_etag, 'EX', ARGV[6])
+end
+redis.call('PUBLISH', ARGV[3], ARGV[4])
+return {'ok', new_etag, current, merged}
+"""
+
+DELETE_STALE_OBJECTS_SCRIPT = """
+-- Delete the hashes of a normalized object and all of its descendants, except the ones to keep.
+-- Runs before a plan is rewritten, so objects the new version no longer has do not linger.
+-- ARGV[1] id of the root object, ARGV[2..] ids to keep
+-- The hashes are found by walking `_children`, their keys are 'object:' .. id as in
+-- services/normalized_store.py and cannot be declared up front
+-- Returns the number of deleted hashes
+local keep = {}
+for i = 2, #ARGV do
+    keep[ARGV[i]] = true
+end
+
+local deleted = 0
+local pending = {ARGV[1]}
+while #pending > 0 do
+    local object_id = table.remove(pending)
+    local key = 'object:' .. object_id
+    local children = redis.call('HGET', key, '_children')
+    if children then
+        for _, child in pairs(cjson.decode(children)) do
+            if type(child) == 'table' then
+                for _, item in ipairs(child) do
+                    table.insert(pending, item)
+                end
+            else
+                table.insert(pending, child)
+            end
+        end
+        if not keep[object_id] then
+            redis.call('DEL', key)
+            deleted = deleted + 1
+        end
+    end
+end
+return deleted
+"""
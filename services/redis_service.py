@@ -1,24 +1,132 @@
 import json
 from hashlib import md5
 
-from extensions import redis_client
+from config import Config
+from extensions import redis_client, plan_cache, plan_codec
 from data_models.medical_plan import PlanSchema, PatchPlanSchema
+from services import normalized_store
+
+
+def _plan_json(object_id, plan_data):
+    """JSON bytes of a stored plan in either storage layout, None if its objects are gone."""
+    if normalized_store.is_normalized(plan_data):
+        plan = normalized_store.read(redis_client, object_id)
+        return json.dumps(plan).encode('utf-8') if plan else None
+    return plan_codec.to_json(plan_data)
+
+
+def _key_id(key):
+    return key.decode('utf-8').split(':', 1)[1]
+
+
+def _plans_json(keys):
+    """
+    JSON bytes of the plans stored under `keys` that still exist. The objects of all
+    normalized plans among them are read together, one round trip per level.
+    """
+    values = redis_client.mget(keys)
+    normalized_ids = [_key_id(key) for key, plan_data in zip(keys, values)
+                      if plan_data and normalized_store.is_normalized(plan_data)]
+    normalized = dict(zip(normalized_ids, normalized_store.read_many(redis_client, normalized_ids)))
+
+    plans = []
+    for key, plan_data in zip(keys, values):
+        if plan_data and normalized_store.is_normalized(plan_data):
+            plan = normalized[_key_id(key)]
+            plan_data = json.dumps(plan).encode('utf-8') if plan else None
+        elif plan_data:
+            plan_data = plan_codec.to_json(plan_data)
+        if plan_data:
+            plans.append(plan_data)
+    return plans
 
 
-def get_plan(object_id: str):
+def get_raw_plan(object_id: str):
+    """JSON bytes of a plan and its ETag, JSON-stored plans are not parsed at all."""
     try:
-        record_key = f"plan:{object_id}"
-        plan_data = redis_client.get(record_key)
+        cached = plan_cache.get(object_id)
+        if cached:
+            return cached
+
+        version = plan_cache.version()
+        plan_data, etag = redis_client.mget(f"plan:{object_id}", f"etag:{object_id}")
         if plan_data:
-            # Calculate ETag
-            etag = md5(plan_data).hexdigest()
-            return PatchPlanSchema.parse_raw(plan_data), etag
+            # Plans written before ETags were stored get theirs calculated
+            etag = etag.decode('utf-8') if etag else md5(plan_data).hexdigest()
+            plan_data = _plan_json(object_id, plan_data)
+            if plan_data:
+                plan_cache.put(object_id, plan_data, etag, version)
+                return plan_data, etag
+        return None, None
+    except (ConnectionError, TimeoutError) as e:
+        # Handle the exception (logging, retrying, etc.)
+        raise e
+
+
+def get_raw_plans(object_ids):
+    """JSON bytes of the given plans in order, skipping ones that no longer exist."""
+    try:
+        if not object_ids:
+            return []
+        plans = []
+        for object_id, plan_data in zip(object_ids, redis_client.mget([f"plan:{object_id}" for object_id in object_ids])):
+            plan_data = plan_data and _plan_json(object_id, plan_data)
+            if plan_data:
+                plans.append(plan_data)
+        return plans
+    except (ConnectionError, TimeoutError) as e:
+        # Handle the exception (logging, retrying, etc.)
+        raise e
+
+
+def get_plan(object_id: str):
+    plan_data, etag = get_raw_plan(object_id)
+    if plan_data:
+        return PatchPlanSchema.parse_raw(plan_data), etag
+    return None, None
+
+
+def get_service(plan_id: str, service_id: str):
+    """
+    JSON bytes of one linkedPlanServices item and the ETag of its plan.
+
+    Normalized plans only load the service's own objects.
+    """
+    try:
+        plan_data, etag = redis_client.mget(f"plan:{plan_id}", f"etag:{plan_id}")
+        if not plan_data:
+            return None, None
+        etag = etag.decode('utf-8') if etag else md5(plan_data).hexdigest()
+        if normalized_store.is_normalized(plan_data):
+            service = normalized_store.read(redis_client, service_id, parent_id=plan_id)
+        else:
+            services = plan_codec.decode(plan_data).get('linkedPlanServices') or []
+            service = next((item for item in services if item.get('objectId') == service_id), None)
+        if service:
+            return json.dumps(service).encode('utf-8'), etag
         return None, None
     except (ConnectionError, TimeoutError) as e:
         # Handle the exception (logging, retrying, etc.)
         raise e
 
 
+def get_etag(object_id: str):
+    """ETag of a plan without loading the plan, None if it does not exist."""
+    try:
+        cached = plan_cache.get(object_id)
+        if cached:
+            return cached[1]
+
+        etag = redis_client.get(f"etag:{object_id}")
+        if etag:
+            return etag.decode('utf-8')
+        plan_data = redis_client.get(f"plan:{object_id}")
+        return md5(plan_data).hexdigest() if plan_data else None
+    except (ConnectionError, TimeoutError) as e:
+        # Handle the exception (logging, retrying, etc.)
+        raise e
+
+
 def merge_records(existing_record, new_record):
     # Create a deep copy of the existing record to avoid modifying it directly
     merged_record = existing_record.copy()
@@ -65,25 +173,48 @@ def patch_item(new_plan: PatchPlanSchema, current_plan: PlanSchema):
         record_key = f"plan:{new_plan.objectId}"
         current_plan = current_plan.dict()
 
-        merged_record = json.dumps(merge_records(current_plan, new_plan.dict()))
-        redis_client.set(record_key, merged_record)
-
-        updated_etag = md5(merged_record.encode('utf-8')).hexdigest()
+        merged_record = plan_codec.encode(merge_records(current_plan, new_plan.dict()))
+        updated_etag = md5(merged_record).hexdigest()
+        redis_client.mset({record_key: merged_record, f"etag:{new_plan.objectId}": updated_etag})
+        redis_client.publish(Config.PLAN_INVALIDATION_CHANNEL, new_plan.objectId)
         return updated_etag
     except (ConnectionError, TimeoutError) as e:
         # Handle the exception (logging, retrying, etc.)
         raise e
 
 
-def get_all_plans():
+def scan_plan_keys(cursor: int, limit: int):
+    """
+    SCAN `plan:*` keys from `cursor` until about `limit` keys were found.
+
+    SCAN pages are never split, so a page can be slightly larger than `limit`.
+    Returns the keys and the cursor to continue from, 0 once the scan is complete.
+    """
+    keys = []
+    while True:
+        cursor, batch = redis_client.scan(cursor=cursor, match="plan:*", count=limit - len(keys))
+        keys.extend(batch)
+        if cursor == 0 or len(keys) >= limit:
+            return keys, cursor
+
+
+def get_all_plans(cursor: int, limit: int):
     try:
-        keys = redis_client.keys("plan:*")
+        keys, next_cursor = scan_plan_keys(cursor, limit)
         plans = []
-        for key in keys:
-            plan_data = redis_client.get(key)
-            if plan_data:
-                plans.append(PatchPlanSchema.parse_raw(plan_data))
-        return plans
+        if keys:
+            plans = [PatchPlanSchema.parse_raw(plan_data) for plan_data in _plans_json(keys)]
+        return plans, next_cursor
     except (ConnectionError, TimeoutError) as e:
         # Handle the exception (logging, retrying, etc.)
         raise e
+
+
+def iter_raw_plans(batch_size: int, cursor: int = 0):
+    """Yield the JSON bytes of every plan, loading one SCAN page per MGET."""
+    while True:
+        keys, cursor = scan_plan_keys(cursor, batch_size)
+        if keys:
+            yield from _plans_json(keys)
+        if cursor == 0:
+            return
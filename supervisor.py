@@ -0,0 +1,52 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from config import Config
+
+RESTART_DELAY = 1
+CONSUMER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'consumer.py')
+
+
+def start_worker(shard):
+    print(f"Starting consumer for shard {shard}")
+    return subprocess.Popen([sys.executable, CONSUMER_PATH, str(shard)])
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def supervise(shards):
+    """Run one consumer process per shard and restart any that exit."""
+    # systemd and docker stop services with SIGTERM, which has to stop the consumers too
+    signal.signal(signal.SIGTERM, stop)
+    workers = {shard: start_worker(shard) for shard in shards}
+    try:
+        while True:
+            time.sleep(RESTART_DELAY)
+            for shard, worker in workers.items():
+                if worker.poll() is not None:
+                    print(f"Consumer for shard {shard} exited with {worker.returncode}, restarting")
+                    workers[shard] = start_worker(shard)
+    except KeyboardInterrupt:
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.wait()
+
+
+if __name__ == '__main__':
+    # `python supervisor.py` runs every shard, `python supervisor.py 0 1` only some of
+    # them so the shards can be spread across hosts.
+    if len(sys.argv) > 1:
+        shards = [int(shard) for shard in sys.argv[1:]]
+    else:
+        shards = range(Config.QUEUE_SHARDS)
+    # Checked once here, a consumer started for a missing shard would be restarted forever
+    missing = [shard for shard in shards if not 0 <= shard < Config.QUEUE_SHARDS]
+    if missing:
+        sys.exit(f"Shards {missing} do not exist, QUEUE_SHARDS is {Config.QUEUE_SHARDS}")
+    supervise(shards)
@@ -0,0 +1,45 @@
+import copy
+import hashlib
+import json
+import os
+
+import fakeredis
+import pytest
+
+# consumer.py builds its (lazily connecting) clients at import and needs these
+os.environ.setdefault('ES_PASSWORD', 'test')
+
+PLAN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'use case.json')
+
+with open(PLAN_PATH) as f:
+    PLAN = json.load(f)
+
+
+@pytest.fixture
+def plan():
+    return copy.deepcopy(PLAN)
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_client(redis_server):
+    return fakeredis.FakeStrictRedis(server=redis_server)
+
+
+@pytest.fixture
+def lua_redis_client(redis_server, redis_client):
+    """
+    fakeredis with Lua scripting. Its Lua has no redis.sha1hex, which the merge script
+    needs, so it is added to the server's runtime. That runtime is a fakeredis internal,
+    the tests are skipped on versions without it.
+    """
+    redis_client.eval('return 1', 0)
+    runtime = getattr(redis_server, '_lua_runtime', None)
+    if runtime is None:
+        pytest.skip('fakeredis has no Lua runtime to add redis.sha1hex to')
+    runtime.globals().redis.sha1hex = lambda data: hashlib.sha1(data).hexdigest().encode('utf-8')
+    return redis_client
@@ -0,0 +1,54 @@
+from consumer import coalesce
+
+
+def patch(operation_id, etag=None, **fields):
+    message = {'action': 'patch', 'operation_id': operation_id, 'document': {'objectId': 'p', **fields}}
+    if etag:
+        message['etag'] = etag
+    return message
+
+
+def create(operation_id, plan_id='p'):
+    return {'action': 'create', 'operation_id': operation_id, 'document': {'objectId': plan_id}}
+
+
+def delete(operation_id, plan_id='p'):
+    return {'action': 'delete', 'operation_id': operation_id, 'doc_id': plan_id}
+
+
+def test_patches_are_applied_one_by_one():
+    # Each patch has to pass its own ETag check, even with the same ETag as the one before
+    messages = [patch('a', etag='E', planType='alice'), patch('b', etag='E', planType='bob'), patch('c', org='x')]
+
+    assert coalesce(list(messages)) == messages
+
+
+def test_delete_supersedes_earlier_writes_with_their_own_action():
+    messages = coalesce([create('c'), patch('p1', org='x'), patch('p2', org='y'), delete('d')])
+
+    assert messages == [{**delete('d'), 'superseded': [{'action': 'create', 'operation_ids': ['c']},
+                                                       {'action': 'patch', 'operation_ids': ['p1']},
+                                                       {'action': 'patch', 'operation_ids': ['p2']}]}]
+
+
+def test_repeated_delete_completes_with_the_first():
+    messages = coalesce([delete('d1'), delete('d2')])
+
+    assert messages == [{**delete('d1'), 'operation_ids': ['d1', 'd2']}]
+
+
+def test_create_after_delete_keeps_both():
+    messages = coalesce([delete('d'), create('c')])
+
+    assert messages == [delete('d'), create('c')]
+
+
+def test_other_plans_keep_their_order_and_deliveries_follow_the_messages():
+    messages = [create('c1', 'p'), create('c2', 'q'), delete('d', 'p')]
+    deliveries = {id(message): [index] for index, message in enumerate(messages)}
+
+    coalesced = coalesce(messages, deliveries)
+
+    assert [message['operation_id'] for message in coalesced] == ['d', 'c2']
+    assert sorted(deliveries[id(coalesced[0])]) == [0, 2]
+    assert deliveries[id(coalesced[1])] == [1]
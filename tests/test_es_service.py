@@ -0,0 +1,61 @@
+import copy
+
+from services.es_service import diff_operations, plan_to_operations, service_diff_operations
+
+
+def ids(operations, action):
+    return [operation[action]['_id'] for operation in operations if action in operation]
+
+
+def test_unchanged_plan_needs_no_operations(plan):
+    assert diff_operations(plan, copy.deepcopy(plan)) == []
+
+
+def test_changed_fields_become_partial_updates(plan):
+    new_plan = copy.deepcopy(plan)
+    new_plan['planType'] = 'outOfNetwork'
+    new_plan['linkedPlanServices'][0]['planserviceCostShares']['copay'] = 99
+    cost_shares_id = new_plan['linkedPlanServices'][0]['planserviceCostShares']['objectId']
+
+    operations = diff_operations(plan, new_plan)
+
+    assert operations == [
+        {'update': {'_index': 'plans', '_id': plan['objectId']}}, {'doc': {'planType': 'outOfNetwork'}},
+        {'update': {'_index': 'plans', '_id': cost_shares_id, 'routing': plan['objectId']}}, {'doc': {'copay': 99}},
+    ]
+
+
+def test_new_services_are_indexed_and_removed_ones_deleted(plan):
+    new_plan = copy.deepcopy(plan)
+    removed = new_plan['linkedPlanServices'].pop(0)
+    added = copy.deepcopy(removed)
+    for item in (added, added['linkedService'], added['planserviceCostShares']):
+        item['objectId'] = 'new-' + item['objectId']
+
+    new_plan['linkedPlanServices'].append(added)
+    operations = diff_operations(plan, new_plan)
+
+    assert ids(operations, 'index') == [added['objectId'], added['linkedService']['objectId'],
+                                        added['planserviceCostShares']['objectId']]
+    assert ids(operations, 'delete') == [removed['objectId'], removed['linkedService']['objectId'],
+                                         removed['planserviceCostShares']['objectId']]
+    assert ids(operations, 'update') == []
+
+
+def test_every_child_is_routed_by_the_plan(plan):
+    new_plan = copy.deepcopy(plan)
+    new_plan['linkedPlanServices'] = []
+
+    for operation in plan_to_operations(plan)[2::2] + diff_operations(plan, new_plan):
+        assert next(iter(operation.values()))['routing'] == plan['objectId']
+
+
+def test_service_diff_covers_only_that_service(plan):
+    service = plan['linkedPlanServices'][1]
+    new_service = copy.deepcopy(service)
+    new_service['linkedService']['name'] = 'Renamed'
+
+    assert service_diff_operations(service, new_service, plan['objectId']) == [
+        {'update': {'_index': 'plans', '_id': service['linkedService']['objectId'], 'routing': plan['objectId']}},
+        {'doc': {'name': 'Renamed'}},
+    ]
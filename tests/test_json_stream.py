@@ -0,0 +1,43 @@
+import io
+import json
+
+import pytest
+
+from services.json_stream import iter_json_array, iter_ndjson
+
+PLANS = [
+    {'objectId': 'a', 'org': 'braces {in} [strings]', 'nested': {'list': [{'x': 1}, {'y': '}'}]}},
+    {'objectId': 'b', 'org': 'escaped \\" quote and \\\\ backslash "{"', 'emoji': 'é☃'},
+    {'objectId': 'c'},
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64 * 1024])
+def test_objects_are_cut_out_whole_at_any_chunk_size(chunk_size):
+    body = json.dumps(PLANS, ensure_ascii=False).encode('utf-8')
+
+    items = list(iter_json_array(io.BytesIO(body), chunk_size=chunk_size))
+
+    assert [json.loads(item) for item in items] == PLANS
+
+
+def test_whitespace_between_elements():
+    body = b'[\n  {"objectId": "a"} ,\n\n  {"objectId": "b"}\n]\n'
+
+    assert list(iter_json_array(io.BytesIO(body), chunk_size=4)) == [b'{"objectId": "a"}', b'{"objectId": "b"}']
+
+
+def test_non_objects_are_yielded_to_fail_validation():
+    items = list(iter_json_array(io.BytesIO(b'[{"objectId": "a"}, 42, null]')))
+
+    assert items == [b'{"objectId": "a"}', b'42', b'null']
+
+
+def test_truncated_object_is_yielded():
+    items = list(iter_json_array(io.BytesIO(b'[{"objectId": "a"}, {"objectId": "b"'), chunk_size=5))
+
+    assert items == [b'{"objectId": "a"}', b'{"objectId": "b"']
+
+
+def test_ndjson_skips_blank_lines_but_counts_them():
+    assert list(iter_ndjson(io.BytesIO(b'{"a": 1}\n\n  \n{"b": 2}'))) == [(1, b'{"a": 1}'), (4, b'{"b": 2}')]
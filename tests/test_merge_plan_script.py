@@ -0,0 +1,111 @@
+import copy
+import json
+from hashlib import sha1
+
+import pytest
+
+from consumer import PatchCommand
+from services.operations import applied_key
+from services.redis_scripts import MERGE_PLAN_SCRIPT
+
+PLAN_KEY = 'plan:12xvxc345ssdsds-508'
+ETAG_KEY = 'etag:12xvxc345ssdsds-508'
+
+
+@pytest.fixture
+def merge(lua_redis_client, plan):
+    lua_redis_client.set(PLAN_KEY, json.dumps(plan))
+    lua_redis_client.set(ETAG_KEY, 'E1')
+    script = lua_redis_client.register_script(MERGE_PLAN_SCRIPT)
+
+    def merge(patch, etag='', marker=None):
+        keys = [PLAN_KEY, ETAG_KEY] + ([marker] if marker else [])
+        return script(keys=keys, args=[json.dumps(patch), etag, 'plan_invalidations', plan['objectId'], 'json', 60])
+
+    return merge
+
+
+def stored(redis_client):
+    return json.loads(redis_client.get(PLAN_KEY))
+
+
+def test_merges_cost_shares_and_ignores_nulls(merge, redis_client, plan):
+    status, *_ = merge({'objectId': plan['objectId'],
+                        'planCostShares': {'objectId': plan['planCostShares']['objectId'], 'copay': 99, 'org': None}})
+
+    assert status == b'ok'
+    cost_shares = stored(redis_client)['planCostShares']
+    assert cost_shares['copay'] == 99
+    assert cost_shares['org'] == plan['planCostShares']['org']
+    assert cost_shares['deductible'] == plan['planCostShares']['deductible']
+
+
+def test_merges_existing_services_and_appends_new_ones(merge, redis_client, plan):
+    service = plan['linkedPlanServices'][0]
+    new_service = copy.deepcopy(service)
+    new_service['objectId'] = 'new-service'
+    merge({'objectId': plan['objectId'], 'linkedPlanServices': [
+        {'objectId': service['objectId'], 'linkedService': {'objectId': service['linkedService']['objectId'],
+                                                            'name': 'Renamed', 'org': None}},
+        new_service,
+    ]})
+
+    services = stored(redis_client)['linkedPlanServices']
+    assert [item['objectId'] for item in services] == [item['objectId'] for item in plan['linkedPlanServices']] + \
+        ['new-service']
+    assert services[0]['linkedService']['name'] == 'Renamed'
+    assert services[0]['linkedService']['org'] == service['linkedService']['org']
+    assert services[0]['planserviceCostShares'] == service['planserviceCostShares']
+
+
+def test_empty_top_level_fields_are_ignored(merge, redis_client, plan):
+    merge({'objectId': plan['objectId'], 'planType': 'outOfNetwork', 'org': ''})
+
+    assert stored(redis_client)['planType'] == 'outOfNetwork'
+    assert stored(redis_client)['org'] == plan['org']
+
+
+def test_same_result_as_the_python_merge(merge, redis_client, plan):
+    service = plan['linkedPlanServices'][1]
+    patch = {'objectId': plan['objectId'], 'planType': 'outOfNetwork',
+             'planCostShares': {'objectId': plan['planCostShares']['objectId'], 'deductible': 1},
+             'linkedPlanServices': [{'objectId': service['objectId'],
+                                     'planserviceCostShares': {'objectId': service['planserviceCostShares']['objectId'],
+                                                               'copay': 7}}]}
+    merge(patch)
+
+    assert stored(redis_client) == PatchCommand({}).merge_records(copy.deepcopy(plan), patch)
+
+
+def test_etag_is_the_sha1_of_the_stored_plan(merge, redis_client, plan):
+    status, etag, old, merged = merge({'objectId': plan['objectId'], 'planType': 'outOfNetwork'}, etag='E1')
+
+    assert status == b'ok'
+    assert redis_client.get(PLAN_KEY) == merged
+    assert etag == sha1(merged).hexdigest().encode('utf-8') == redis_client.get(ETAG_KEY)
+    assert json.loads(old) == plan
+
+
+def test_rejects_a_stale_etag(merge, redis_client, plan):
+    before = redis_client.get(PLAN_KEY)
+
+    assert merge({'objectId': plan['objectId'], 'planType': 'outOfNetwork'}, etag='E0') == [b'conflict', b'E1']
+    assert redis_client.get(PLAN_KEY) == before
+
+
+def test_missing_plan(merge, redis_client, plan):
+    redis_client.delete(PLAN_KEY)
+
+    assert merge({'objectId': plan['objectId'], 'planType': 'outOfNetwork'}) == [b'missing']
+
+
+def test_redelivered_patch_is_recognised_by_its_marker(merge, redis_client, plan):
+    marker = applied_key('op')
+    status, etag, *_ = merge({'objectId': plan['objectId'], 'planType': 'outOfNetwork'}, etag='E1', marker=marker)
+    assert status == b'ok'
+    assert redis_client.get(marker) == etag
+    assert redis_client.ttl(marker) > 0
+
+    # Its own first attempt changed the ETag, the marker wins over the conflict
+    assert merge({'objectId': plan['objectId'], 'planType': 'inNetwork'}, etag='E1', marker=marker) == [b'applied', etag]
+    assert stored(redis_client)['planType'] == 'outOfNetwork'
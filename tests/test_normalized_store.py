@@ -0,0 +1,112 @@
+import asyncio
+import copy
+import json
+
+import fakeredis
+import pytest
+
+from services import normalized_store
+
+
+class CountingClient:
+    """Counts the pipelines a read sends, each one is a round trip."""
+
+    def __init__(self, client):
+        self.client = client
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        self.round_trips += 1
+        return self.client.pipeline(transaction=transaction)
+
+
+def copy_of(plan, plan_id):
+    other = copy.deepcopy(plan)
+
+    def rename(obj):
+        obj['objectId'] = f"{plan_id}-{obj['objectId']}"
+        for value in obj.values():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict):
+                    rename(item)
+    rename(other)
+    return other
+
+
+@pytest.fixture
+def stored(redis_client):
+    def stored(*plans):
+        pipeline = redis_client.pipeline()
+        for plan in plans:
+            normalized_store.write(pipeline, plan)
+        pipeline.execute()
+    return stored
+
+
+def test_flatten_keeps_types_and_links_objects(plan):
+    objects = normalized_store.flatten(plan)
+    service = plan['linkedPlanServices'][0]
+
+    assert len(objects) == 2 + 3 * len(plan['linkedPlanServices'])
+    root = objects[plan['objectId']]
+    assert json.loads(root['_parent']) is None
+    assert json.loads(root['_children']) == {
+        'planCostShares': plan['planCostShares']['objectId'],
+        'linkedPlanServices': [item['objectId'] for item in plan['linkedPlanServices']],
+    }
+    cost_shares = objects[service['planserviceCostShares']['objectId']]
+    assert json.loads(cost_shares['copay']) == service['planserviceCostShares']['copay']
+    assert json.loads(cost_shares['_parent']) == service['objectId']
+
+
+def test_read_assembles_the_plan(redis_client, stored, plan):
+    stored(plan)
+
+    assert normalized_store.read(redis_client, plan['objectId']) == plan
+    assert normalized_store.read(redis_client, 'missing') is None
+
+
+def test_read_checks_the_parent(redis_client, stored, plan):
+    stored(plan)
+    service = plan['linkedPlanServices'][0]
+
+    assert normalized_store.read(redis_client, service['objectId'], parent_id=plan['objectId']) == service
+    assert normalized_store.read(redis_client, service['objectId'], parent_id='other-plan') is None
+
+
+def test_write_diff_writes_only_changed_fields(redis_client, stored, plan):
+    stored(plan)
+    merged = copy.deepcopy(plan)
+    merged['planCostShares']['copay'] = 99
+    removed = merged['linkedPlanServices'].pop()
+
+    pipeline = redis_client.pipeline()
+    normalized_store.write_diff(pipeline, plan, merged)
+    commands = [command for command, _ in pipeline.command_stack]
+    pipeline.execute()
+
+    assert normalized_store.read(redis_client, plan['objectId']) == merged
+    assert not redis_client.exists(normalized_store.object_key(removed['objectId']))
+    # The root's _children, the cost shares' copay and the removed service's three objects
+    assert len(commands) == 5
+
+
+def test_a_page_of_plans_costs_the_round_trips_of_one(redis_client, stored, plan):
+    plans = [copy_of(plan, plan_id) for plan_id in 'abc']
+    stored(*plans)
+    client = CountingClient(redis_client)
+
+    assert normalized_store.read_many(client, [p['objectId'] for p in plans] + ['missing']) == plans + [None]
+    # Plan, its services and cost shares, the services' children
+    assert client.round_trips == 3
+
+
+def test_async_read_matches_read(stored, redis_server, plan):
+    stored(plan)
+
+    async def read():
+        client = fakeredis.aioredis.FakeRedis(server=redis_server)
+        return (await normalized_store.async_read(client, plan['objectId']),
+                await normalized_store.async_read_many(client, [plan['objectId'], 'missing']))
+
+    assert asyncio.run(read()) == (plan, [plan, None])
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+import fakeredis
+import pytest
+
+from services.operations import AsyncOperationWaiter, operation_key, requested_wait
+
+
+@pytest.mark.parametrize('prefer, wait, expected', [
+    ('wait=5', None, 5),
+    ('respond-async, wait=5', '1', 5),
+    (None, '3', 3),
+    (None, None, 0),
+    (None, 'soon', 0),
+    ('wait=300', None, 30),
+])
+def test_requested_wait(prefer, wait, expected):
+    assert requested_wait(prefer, wait, 30) == expected
+
+
+def test_async_waiter_wakes_on_completion(redis_server):
+    async def run():
+        client = fakeredis.aioredis.FakeRedis(server=redis_server)
+        waiter = AsyncOperationWaiter(channel='operations')
+        waiter.start(client)
+
+        async def complete():
+            await asyncio.sleep(0.1)
+            await client.set(operation_key('op'), json.dumps({'operation_id': 'op', 'status': 'done'}))
+            await client.publish('operations', 'op')
+
+        asyncio.get_running_loop().create_task(complete())
+        try:
+            return await asyncio.wait_for(waiter.wait('op', 30), 5), await waiter.wait('other', 0.1)
+        finally:
+            await waiter.close()
+
+    assert asyncio.run(run()) == ({'operation_id': 'op', 'status': 'done'}, None)
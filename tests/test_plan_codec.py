@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from services.plan_codec import CODECS, NORMALIZED, PlanCodec
+
+
+@pytest.mark.parametrize('name', list(CODECS))
+def test_round_trip(name, plan):
+    codec = PlanCodec(name)
+
+    assert codec.decode(codec.encode(plan)) == plan
+    assert json.loads(codec.to_json(codec.encode(plan))) == plan
+
+
+@pytest.mark.parametrize('name', list(CODECS))
+def test_every_codec_reads_every_format(name, plan):
+    # Switching PLAN_CODEC must not strand the plans stored before
+    stored = [PlanCodec(other).encode(plan) for other in CODECS]
+
+    assert [PlanCodec(name).decode(value) for value in stored] == [plan] * len(CODECS)
+
+
+def test_plans_stored_before_the_codec_are_json(plan):
+    legacy = json.dumps(plan).encode('utf-8')
+
+    assert PlanCodec('msgpack+zlib').decode(legacy) == plan
+    assert PlanCodec('msgpack').to_json(legacy) is legacy
+
+
+def test_only_msgpack_zlib_is_compressed(plan):
+    assert [PlanCodec(name).compressed for name in CODECS] == [False, False, True]
+    assert len(PlanCodec('msgpack+zlib').encode(plan)) < len(PlanCodec('json').encode(plan))
+
+
+def test_normalized_marker_is_not_decoded():
+    with pytest.raises(ValueError):
+        PlanCodec().decode(bytes([NORMALIZED]))
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        PlanCodec('pickle')
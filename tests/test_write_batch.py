@@ -0,0 +1,75 @@
+import json
+
+import elasticsearch
+import pytest
+import redis
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+
+import consumer
+from consumer import WriteBatch, unavailable
+from services.operations import operation_key
+
+
+class FakeElasticsearch:
+    def __init__(self, status=None):
+        self.status = status
+
+    def bulk(self, operations):
+        items = []
+        for operation in operations:
+            action, meta = next(iter(operation.items()))
+            if action not in ('index', 'update', 'delete') or len(operation) != 1:
+                continue
+            item = {'_id': meta['_id'], 'status': self.status or 200}
+            if self.status:
+                item['error'] = {'type': 'es_rejected_execution_exception'}
+            items.append({action: item})
+        return {'errors': bool(self.status), 'items': items}
+
+
+@pytest.fixture
+def batch(monkeypatch, redis_client):
+    monkeypatch.setattr(consumer, 'redis_client', redis_client)
+    batch = WriteBatch()
+    batch.add('plan:p', [{'index': {'_index': 'plans', '_id': 'p'}}, {'objectId': 'p'}],
+              lambda pipeline: pipeline.set('plan:p', 'value'))
+    batch.add_result('plan:p', ['op'], {'action': 'create', 'status': 'done', 'etag': None, 'error': None})
+    return batch
+
+
+def api_error(status):
+    meta = ApiResponseMeta(status, '1.1', HttpHeaders(), 0.0, NodeConfig('http', 'localhost', 9200))
+    return elasticsearch.ApiError('error', meta, {})
+
+
+@pytest.mark.parametrize('error, expected', [
+    (redis.exceptions.ConnectionError(), True),
+    (redis.exceptions.ReadOnlyError(), True),
+    (redis.exceptions.OutOfMemoryError(), True),
+    (api_error(429), True),
+    (api_error(503), True),
+    (api_error(404), False),
+    (KeyError('document'), False),
+])
+def test_only_transient_errors_are_unavailable(error, expected):
+    assert unavailable(error) is expected
+
+
+def test_overloaded_bulk_items_redeliver_the_batch(monkeypatch, batch, redis_client):
+    monkeypatch.setattr(consumer, 'es', FakeElasticsearch(status=429))
+
+    with pytest.raises(ConnectionError) as raised:
+        batch.flush()
+
+    assert unavailable(raised.value)
+    assert redis_client.get('plan:p') is None
+    assert redis_client.get(operation_key('op')) is None
+
+
+def test_rejected_bulk_items_fail_their_operations(monkeypatch, batch, redis_client):
+    monkeypatch.setattr(consumer, 'es', FakeElasticsearch(status=400))
+
+    batch.flush()
+
+    assert redis_client.get('plan:p') is None
+    assert json.loads(redis_client.get(operation_key('op')))['status'] == 'failed'